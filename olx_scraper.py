@@ -2,12 +2,16 @@ import logging
 import time
 import sys
 import os
-from urllib.parse import urlparse
+import threading
+import uuid
+import math
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qsl
 from configparser import ConfigParser
 
 import keyboard
 import requests
-from bs4 import BeautifulSoup
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
@@ -16,21 +20,60 @@ from selenium.common.exceptions import (
     NoSuchElementException, TimeoutException, ElementClickInterceptedException
 )
 
-from utils.tor_proxy import TorProxy, TOR_SOCKS_PROXIES
-from utils.http_request import HttpRequest
+from utils.tor_proxy import TorProxy, TorPool
+from utils.http_request import (
+    CIRCUIT_MAX_FAILURES,
+
+    HttpRequest,
+    HttpRequestPool,
+    Circuit,
+)
+from utils.json_cache import JsonCache
+from utils.token_provider import TokenProvider
+from utils.rate_limiter import get_rate_limiter
+from utils.quota_ledger import QuotaLedger
+from utils.export_state import ExportState, ChangedItems
+from utils.image_downloader import ImageDownloader, IMAGE_WORKERS
+
+# The asyncio client is optional (see requirements-async.txt)
+try:
+    from utils.async_http_request import AsyncHttpRequest
+except ImportError:
+    AsyncHttpRequest = None
+from utils.listing_parser import (
+    parse_listing,
+    parse_item_ids,
+    parse_random_item_url,
+)
+from utils.item_store import (
+    STORAGE_JSONL,
+    STORAGE_SQLITE,
+    STORAGE_TYPES,
+
+    is_legacy_json,
+    ItemRange,
+    JsonlItemStore,
+    SqliteItemStore,
+)
 from utils.scraping_utils import (
     FATAL_ERROR_STR,
 
     setup_logging,
     clean_phone,
+    get_jwt_expiry,
 
     save_items_csv,
     load_items_csv,
 
     save_items_json,
     load_items_json,
+    save_items_jsonl,
 
     save_items_xlsx,
+    XLSX_TYPE_NUMBER,
+
+    save_items_parquet,
+    parquet_available,
 )
 
 HTTP_HOST = 'https://www.olx.ua'
@@ -40,6 +83,9 @@ LOGIN_URL = (
 )
 
 API_OFFERS_URL = HTTP_HOST + '/api/v1/offers/{}'
+API_OFFERS_LIST_URL = HTTP_HOST + '/api/v1/offers/'
+# Converts the path of a search link to the offers list API parameters
+API_QUERY_PARAMS_URL = HTTP_HOST + '/api/v1/friendly-links/query-params/{}'
 API_PHONES_URL = API_OFFERS_URL + '/limited-phones/'
 API_CATEGORIES_URL = HTTP_HOST + '/api/partner/categories'
 
@@ -47,9 +93,39 @@ LOGOUT_LINK = '/account/logout'
 LOGOUT_URL = HTTP_HOST + LOGOUT_LINK + '/'
 
 CONFIG_FILENAME = 'config.ini'
+
+# Results file of the old versions: indented JSON array of the items
+LEGACY_JSON_FILENAME = 'items.json'
+# SQLite store used when the config doesn't set db_filename
+DB_FILENAME = 'items.db'
 PROGRESS_FILENAME = 'progress.json'
 SEARCH_LINKS_FILENAME = 'search_links.txt'
 
+TOKENS_CACHE_FILENAME = 'tokens.json'
+TOKEN_KEY_PERSONAL = 'personal:'
+TOKEN_KEY_ANONYMOUS = 'anonymous:' # Followed by the circuit index
+# Access token is refreshed this time before its expiration (seconds)
+TOKEN_REFRESH_MARGIN = 5 * 60
+# Assumed token lifetime if it can't be figured out from the token (seconds)
+TOKEN_DEFAULT_TTL = 15 * 60
+
+PHONES_CACHE_FILENAME = 'phones.json'
+# Lifetime of seller phones in the cache (hours)
+PHONE_CACHE_TTL = 7 * 24
+
+# The phones cache file grows with the sellers count, so it's saved only if
+# changed and not more often than this interval (seconds)
+PHONES_CACHE_SAVE_INTERVAL = 60
+
+QUOTA_LEDGER_FILENAME = 'quota.json'
+# Protected phone numbers allowed to be viewed per account daily
+PHONE_QUOTA = 40
+
+CATEGORIES_CACHE_FILENAME = 'categories.json'
+CATEGORIES_CACHE_KEY = 'categories'
+# Categories list lifetime in the cache (seconds)
+CATEGORIES_CACHE_TTL = 24 * 60 * 60
+
 ACCOUNTS_FILENAME = 'accounts.csv'
 ACCOUNTS_COLUMNS = ['login', 'password']
 
@@ -57,8 +133,109 @@ SLEEP_TIME = 0
 PAGE_LOAD_TIMEOUT = 45
 WAIT_TIMEOUT = 10
 WAIT_CLICK = 1.0
-# WAIT_FORBIDDEN_RETRY = 60
-WAIT_FORBIDDEN_RETRY = 100
+
+# Number of TOR instances used for anonymous phone requests. Each of them
+# has its own anonymous access token.
+TOR_INSTANCES = 1
+# Maximum time to wait for an enabled TOR circuit (seconds)
+CIRCUIT_WAIT_TIMEOUT = 3 * 60
+# Delay before retrying a failed circuit refresh (seconds). It's doubled
+# after every failure up to the maximum.
+CIRCUIT_REFRESH_DELAY = 10
+CIRCUIT_REFRESH_MAX_DELAY = 5 * 60
+
+# Listing modes: search result HTML pages plus an offers API request per
+# item, or the offers list API returning complete offers
+LISTING_MODE_HTML = 'html'
+LISTING_MODE_API = 'api'
+LISTING_MODES = [LISTING_MODE_HTML, LISTING_MODE_API]
+
+# Offers count per offers list API request
+API_PAGE_LIMIT = 40
+
+# Offers list API returns no more than this offers count for a search
+API_MAX_OFFSETS = 1000
+
+# Search link query string keys and their offers list API counterparts. The
+# search[filter_...] keys are passed without the search[] wrapper, e.g.
+# search[filter_enum_state][0] becomes filter_enum_state[0].
+API_QUERY_KEYS = {
+    'search[order]': 'sort_by',
+    'search[private_business]': 'owner_type',
+    'search[dist]': 'distance',
+    'currency': 'currency',
+}
+API_FILTER_QUERY_PREFIX = 'search[filter_'
+API_IGNORED_QUERY_KEYS = ['page']
+
+# Number of item offers fetched concurrently for a single listing page
+ITEM_WORKERS = 8
+
+# Deferred phone resolving: contact phones of the stored items are marked
+# as pending until a phone worker retrieves them
+PHONES_PENDING = 'PENDING'
+PHONE_WORKERS = 1
+# Minimal interval between phone requests of all the workers (seconds)
+PHONE_INTERVAL = 0
+# Failed phone tasks are dropped after this count of attempts
+PHONE_MAX_ATTEMPTS = 3
+# Failed phone task is retried after this delay doubled with every attempt
+# (seconds)
+PHONE_RETRY_DELAY = 30
+# Idle phone worker checks the queue with this period (seconds)
+PHONE_QUEUE_POLL = 5
+
+# XLSX export column options: widths (in characters) and non-string types
+XLSX_COLUMN_WIDTHS = {
+    'url': 40,
+    'title': 40,
+    'category': 40,
+    'last_refresh_time': 20,
+    'created_time': 20,
+    'description': 80,
+    'photos': 40,
+    'contact_phones': 30,
+    'user_created': 20,
+    'user_last_seen': 20,
+}
+XLSX_COLUMN_TYPES = {
+    'id': XLSX_TYPE_NUMBER,
+    'user_id': XLSX_TYPE_NUMBER,
+}
+
+# Parquet export column options
+PARQUET_DICTIONARY_COLUMNS = ['category', 'city', 'region', 'state']
+PARQUET_TIMESTAMP_COLUMNS = [
+    'created_time', 'last_refresh_time', 'user_created', 'user_last_seen'
+]
+PARQUET_INTEGER_COLUMNS = ['id', 'user_id']
+
+# Export modes: all the items are saved to the result files or only the items
+# added or changed since the previous export are saved to new delta files
+EXPORT_MODE_FULL = 'full'
+EXPORT_MODE_DELTA = 'delta'
+EXPORT_MODES = [EXPORT_MODE_FULL, EXPORT_MODE_DELTA]
+
+# The state of delta exports, kept when the progress is reset
+EXPORT_STATE_FILENAME = 'export_state.db'
+
+# Delta files are named after the result files with this timestamp suffix
+# followed by the export number, so the exports made within one second
+# don't overwrite each other
+DELTA_SUFFIX_FORMAT = '_%Y%m%d_%H%M%S'
+
+# Period of the exports during scraping (seconds). Zero means the results
+# are exported after scraping only.
+EXPORT_INTERVAL = 0
+
+# Phones API requests have their own rate limits. Its 429 response means the
+# account phone quota is exhausted, not throttling, so only 403 slows down
+# the phones requests.
+RATE_LIMIT_KEY_PHONES = 'olx phones'
+PHONES_THROTTLE_STATUS_CODES = [403]
+
+# Retries of the personal phones request refused with 403
+PHONE_FORBIDDEN_RETRIES = 5
 
 HOTKEY_TERMINATE = 'ctrl+alt+F12'
 
@@ -66,33 +243,88 @@ class ScraperOLX():
     def __init__(self):
         setup_logging()
 
-        self.request = HttpRequest(sleep_time=SLEEP_TIME)
-        self.api_request = HttpRequest(sleep_time=SLEEP_TIME)
-        self.api_proxy_request = HttpRequest(sleep_time=SLEEP_TIME,
-                                             proxies=TOR_SOCKS_PROXIES)
-        self.api_v2_request = HttpRequest(sleep_time=SLEEP_TIME)
+        self.tor_pool = None
+
+        # Direct requests to OLX share adaptive rate limits. Requests made
+        # via TOR circuits aren't limited: they have different IPs.
+        self.request = HttpRequest(sleep_time=SLEEP_TIME, rate_limit=True)
+        self.api_request = HttpRequest(sleep_time=SLEEP_TIME,
+                                       pool_maxsize=ITEM_WORKERS,
+                                       rate_limit=True)
+        self.api_proxy_pool = None # One circuit per TOR instance
+        self.api_v2_request = HttpRequest(sleep_time=SLEEP_TIME,
+                                          rate_limit=True)
         self.api_v2_request.headers['Version'] = '2.0'
-
-        self.tor_proxy = TorProxy()
+        get_rate_limiter(RATE_LIMIT_KEY_PHONES).throttle_status_codes = (
+            PHONES_THROTTLE_STATUS_CODES)
+        self.image_request = HttpRequest(sleep_time=SLEEP_TIME,
+                                         pool_maxsize=IMAGE_WORKERS)
+        self.image_downloader = ImageDownloader(
+            self.image_request,
+            async_request=(AsyncHttpRequest(sleep_time=SLEEP_TIME)
+                           if AsyncHttpRequest != None else None))
+
+        # Each thread (e.g. token providers) uses its own webdriver
+        self.local = threading.local()
         self.driver = None
         self.accounts = []
-        self.categories = []
+        self.categories = {} # key: category id; value: category dict
+        self.breadcrumbs = {} # key: category id; value: breadcrumbs string
+        self.unknown_categories = set() # Categories missing after reloading
+        self.categories_cache = JsonCache(CATEGORIES_CACHE_FILENAME)
+        self.tokens_cache = JsonCache(TOKENS_CACHE_FILENAME)
+        self.phones_cache = JsonCache(PHONES_CACHE_FILENAME)
+        self.phones_cache_saved = 0
+        self.phone_quota = QuotaLedger(QUOTA_LEDGER_FILENAME, PHONE_QUOTA)
+        self.personal_tokens = TokenProvider(self.acquire_token_personal,
+                                             'personal API token',
+                                             margin=TOKEN_REFRESH_MARGIN)
+        self.anonymous_tokens = [] # One provider per TOR circuit
+        self.item_store = None
 
         # Progress variables
         self.account_index = 0
+        self.next_account_index = 0 # For the personal token provider
         self.search_link_index = 0
         self.page = 1
+        self.export_state = ExportState(EXPORT_STATE_FILENAME)
+
+        self.last_export_time = 0
 
         # Configuration variables
         self.csv_filename = 'items.csv'
         self.xlsx_filename = 'items.xlsx'
-        self.json_filename = 'items.json'
+        self.json_filename = 'items.jsonl'
+        self.db_filename = DB_FILENAME
+        self.parquet_filename = '' # Parquet export is disabled if empty
         self.image_dir = 'img'
         self.save_images = False
         self.restart_on_error = False
         self.use_tor = True
+        self.tor_instances = TOR_INSTANCES
+        self.storage = STORAGE_JSONL
+        self.listing_mode = LISTING_MODE_HTML
+        self.export_mode = EXPORT_MODE_FULL
+        self.export_interval = EXPORT_INTERVAL
+        self.item_workers = ITEM_WORKERS
+        self.phone_cache_ttl = PHONE_CACHE_TTL * 60 * 60 # Seconds
+        self.defer_phones = False
+        self.phone_workers = PHONE_WORKERS
+        self.phone_interval = PHONE_INTERVAL
         self.search_links = []
 
+        # Deferred phone resolving state
+        self.phone_tasks = [] # Tasks of the page being scraped
+        self.phone_threads = []
+        self.phone_tasks_active = set()
+        self.phone_lock = threading.Lock()
+        self.phone_next_time = 0
+        self.phone_workers_stop = threading.Event()
+        self.phone_queue_draining = False
+        self.token_lock = threading.Lock()
+        self.progress_lock = threading.Lock()
+        self.personal_token_ready = False
+
         self.should_close = False
         keyboard.add_hotkey(HOTKEY_TERMINATE, self.close_query)
 
@@ -101,6 +333,12 @@ class ScraperOLX():
 
     def cleanup(self):
         keyboard.remove_hotkey(HOTKEY_TERMINATE)
+        self.personal_tokens.stop()
+        for provider in self.anonymous_tokens:
+            provider.stop()
+        if self.api_proxy_pool != None:
+            self.api_proxy_pool.close()
+        self.image_downloader.close()
 
     def close_query(self):
         logging.info('PROGRAM CLOSE QUERY RECEIVED. '
@@ -109,12 +347,20 @@ class ScraperOLX():
 
 ####################### SELENIUM WEBDRIVER INIT / CLOSE #######################
 
-    def init_driver(self, tor_proxy=False) -> bool:
+    @property
+    def driver(self):
+        return getattr(self.local, 'driver', None)
+
+    @driver.setter
+    def driver(self, driver):
+        self.local.driver = driver
+
+    def init_driver(self, tor_proxy: TorProxy=None) -> bool:
         self.close_driver()
 
         try:
-            if tor_proxy:
-                proxy = urlparse(TOR_SOCKS_PROXIES['https'])
+            if tor_proxy != None:
+                proxy = urlparse(tor_proxy.get_proxies()['https'])
 
                 profile = webdriver.FirefoxProfile()
                 profile.set_preference('network.proxy.type', 1)
@@ -243,9 +489,8 @@ class ScraperOLX():
         else:
             return True
 
-    def execute_relogin(self, driver_just_opened=False) -> bool:
-        logging.info('Executing re-login.')
-
+    # Moves the account cursor to the next account
+    def switch_account(self):
         if self.account_index >= len(self.accounts) - 1:
             logging.warning('Out of accounts. Setting account cursor to zero.')
             self.account_index = 0
@@ -255,10 +500,15 @@ class ScraperOLX():
         if not self.save_progress():
             logging.warning("Can't save the next account index to the file.")
 
+    def execute_relogin(self, driver_just_opened=False) -> bool:
+        logging.info('Executing re-login.')
+
+        self.switch_account()
+
         if (not driver_just_opened) and (not self.execute_logout()):
             return False
 
-        if not self.execute_login(driver_just_opened):
+        if not self.execute_login(driver_just_opened=driver_just_opened):
             return False
 
         return True
@@ -272,7 +522,7 @@ class ScraperOLX():
         self.add_auth_header(self.api_request, auth_token)
         self.add_auth_header(self.api_v2_request, auth_token)
 
-    def get_access_token(self) -> str:
+    def get_access_token_cookie(self) -> dict:
         try:
             cookies = self.driver.get_cookies()
         except Exception:
@@ -283,89 +533,316 @@ class ScraperOLX():
         for cookie in cookies:
             # print(cookie)
             if cookie['name'] == 'access_token':
-                return cookie['value']
+                return cookie
 
         # For anonymous access
         for cookie in cookies:
             if cookie['name'] == 'a_access_token':
-                return cookie['value']
+                return cookie
 
         logging.error("Can't find 'access_token' cookie.")
         return None
 
+    # Reads the access token from the webdriver cookies and stores it in the
+    # token cache along with its expiration time
+    def cache_access_token(self, cache_key: str) -> str:
+        cookie = self.get_access_token_cookie()
+        if cookie is None:
+            return None
+
+        access_token = cookie['value']
+
+        expires = get_jwt_expiry(access_token) or cookie.get('expiry')
+        if not expires:
+            expires = time.time() + TOKEN_DEFAULT_TTL
+
+        self.tokens_cache.set(cache_key, access_token, expires=expires)
+        if not self.tokens_cache.save():
+            logging.warning("Can't save access token to the cache.")
+
+        return access_token
+
+    def get_cached_token(self, cache_key: str) -> str:
+        return self.tokens_cache.get(cache_key, margin=TOKEN_REFRESH_MARGIN)
+
     def get_random_item_url(self) -> str:
         html = self.request.get_html(HTTP_HOST)
         if not html:
             return None
 
-        try:
-            item_url = (BeautifulSoup(html, 'lxml')
-                        .find('h4', class_='normal')
-                        .a['href'])
-        except (AttributeError, KeyError):
-            logging.exception('Error while parsing random item URL.')
-            return None
+        return parse_random_item_url(html)
 
-        return item_url
+    # TOR processes are long-lived: each of them is started only once
+    def start_tor(self, index: int, new_identity=False) -> bool:
+        tor_proxy = self.tor_pool[index]
+
+        if new_identity:
+            logging.info(f'Requesting new TOR identity (circuit {index}).')
+            if not tor_proxy.new_identity():
+                return False
+        elif not tor_proxy.is_ready():
+            logging.info(f'Starting TOR (circuit {index}).')
+            if not tor_proxy.start():
+                return False
 
-    def init_token_anonymous(self) -> bool:
-        logging.info('Getting anonymous API token.')
-        logging.info('Starting TOR.')
-        self.tor_proxy.restart(wait=True)
-        if not self.tor_proxy.test_ok():
-            logging.error('Testing TOR: ERROR.')
+        if not tor_proxy.test_ok():
+            logging.error(f'Testing TOR (circuit {index}): ERROR.')
             return False
         else:
-            logging.info('Testing TOR: OK.')
+            logging.info(f'Testing TOR (circuit {index}): OK.')
 
-        if not self.init_driver(tor_proxy=True):
-            return False
+        return True
+
+    # Checks whether the token is the one currently used for API requests
+    def token_in_use(self, access_token: str) -> bool:
+        header = f'Bearer {access_token}'
+        requests_in_use = [self.api_request]
+        if self.api_proxy_pool != None:
+            requests_in_use += [circuit.request
+                                for circuit in self.api_proxy_pool]
+
+        return any(request.headers.get('Authorization') == header
+                   for request in requests_in_use)
+
+    def get_standby_token(self, cache_key: str) -> str:
+        access_token = self.get_cached_token(cache_key)
+        if access_token and not self.token_in_use(access_token):
+            return access_token
+
+        return None
+
+    # Returns the token dict for the token provider
+    def create_token(self, cache_key: str, access_token: str) -> dict:
+        return {
+            'access_token': access_token,
+            'expires': self.tokens_cache.get_expires(cache_key),
+        }
+
+    # Runs in the background thread of the anonymous token provider of the
+    # circuit with the given index
+    def acquire_token_anonymous(self, index: int) -> dict:
+        cache_key = TOKEN_KEY_ANONYMOUS + str(index)
+
+        access_token = self.get_standby_token(cache_key)
+        if access_token:
+            logging.info('Using cached anonymous API token '
+                         + f'(circuit {index}).')
+            if not self.start_tor(index):
+                return None
+            return self.create_token(cache_key, access_token)
+
+        # The webdriver gets a new exit IP
+        if not self.start_tor(index, new_identity=True):
+            return None
+
+        if not self.init_driver(tor_proxy=self.tor_pool[index]):
+            return None
 
         random_url = self.get_random_item_url()
         if random_url is None:
             self.close_driver()
-            return False
+            return None
 
         try:
             self.driver.get(random_url)
         except TimeoutException:
             logging.exception(f'Timeout while loading [{random_url}] page.')
             self.close_driver()
-            return False
+            return None
 
-        access_token = self.get_access_token()
+        access_token = self.cache_access_token(cache_key)
+        self.close_driver()
         if access_token is None:
+            return None
+
+        return self.create_token(cache_key, access_token)
+
+    def get_logins(self) -> list:
+        return [account['login'] for account in self.accounts]
+
+    def log_quota_exhausted(self):
+        reset_time = self.phone_quota.next_reset_time(self.get_logins())
+        if reset_time:
+            reset_time = time.strftime('%d.%m.%Y %H:%M:%S',
+                                       time.localtime(reset_time))
+        logging.error('Phone quota is exhausted for all the accounts. '
+                      + f'The next quota reset time: {reset_time}.')
+
+    # Searches for an account with phone quota budget starting from the
+    # personal token provider cursor. Exhausted accounts are skipped.
+    def next_account_budget_index(self) -> int:
+        for offset in range(len(self.accounts)):
+            account_index = self.next_account_index + offset
+            if account_index == len(self.accounts):
+                logging.warning('Out of accounts. '
+                                'Setting account cursor to zero.')
+            account_index %= len(self.accounts)
+
+            login = self.accounts[account_index]['login']
+            if self.phone_quota.has_budget(login):
+                return account_index
+
+            logging.info(f'Phone quota is exhausted for {login}. Skipping.')
+
+        self.log_quota_exhausted()
+        return None
+
+    # Runs in the background thread of the personal token provider. Each call
+    # prepares a token for the next account with phone quota budget.
+    def acquire_token_personal(self) -> dict:
+        account_index = self.next_account_budget_index()
+        if account_index is None:
+            return None
+        self.next_account_index = account_index + 1
+
+        login = self.accounts[account_index]['login']
+        password = self.accounts[account_index]['password']
+        cache_key = TOKEN_KEY_PERSONAL + login
+
+        access_token = self.get_standby_token(cache_key)
+        if access_token:
+            logging.info(f'Using cached personal API token for {login}.')
+        else:
+            if not self.init_driver():
+                return None
+
+            if not self.execute_login(login, password,
+                                      driver_just_opened=True):
+                self.close_driver()
+                return None
+
+            access_token = self.cache_access_token(cache_key)
             self.close_driver()
+            if access_token is None:
+                return None
+
+        token = self.create_token(cache_key, access_token)
+        token['account_index'] = account_index
+        return token
+
+    # New SOCKS credentials make TOR isolate the following requests of the
+    # circuit on a separate TOR circuit
+    def isolate_circuit(self, circuit: Circuit):
+        circuit.request.set_proxies(self.tor_pool[circuit.index].get_proxies(
+            isolation_key=uuid.uuid4().hex))
+
+    def init_token_anonymous(self, circuit: Circuit) -> bool:
+        logging.info(f'Getting anonymous API token (circuit {circuit.index}).')
+
+        token = self.anonymous_tokens[circuit.index].take()
+        if token is None:
             return False
 
-        self.add_auth_header(self.api_proxy_request, access_token)
-        self.close_driver()
+        self.isolate_circuit(circuit)
+        self.add_auth_header(circuit.request, token['access_token'])
         return True
 
     def init_token_personal(self) -> bool:
         logging.info('Getting personal API token.')
 
-        if not self.init_driver():
-            return False
-
-        if self.api_request.headers.get('Authorization'):
-            if not self.execute_relogin(driver_just_opened=True):
-                self.close_driver()
+        # The standby account may have used up its quota since preparing
+        for attempt in range(len(self.accounts)):
+            token = self.personal_tokens.take()
+            if token is None:
                 return False
+
+            login = self.accounts[token['account_index']]['login']
+            if self.phone_quota.has_budget(login):
+                break
         else:
-            if not self.execute_login(driver_just_opened=True):
-                self.close_driver()
-                return False
+            self.log_quota_exhausted()
+            return False
 
-        access_token = self.get_access_token()
-        if access_token is None:
-            self.close_driver()
+        self.account_index = token['account_index']
+        if not self.save_progress():
+            logging.warning("Can't save the next account index to the file.")
+
+        self.add_auth_headers(token['access_token'])
+        self.personal_token_ready = True
+        return True
+
+    # Drops the token refused by the API from the cache
+    def drop_cached_token(self, cache_key: str, access_token: str):
+        if self.tokens_cache.get(cache_key) == access_token:
+            self.tokens_cache.invalidate(cache_key)
+            if not self.tokens_cache.save():
+                logging.warning("Can't save access tokens cache.")
+
+    # Starts all the TOR instances and gets tokens for their circuits. The
+    # circuits which can't be initialized stay disabled.
+    def init_tor_circuits(self) -> bool:
+        logging.info(f'Starting {len(self.tor_pool)} TOR instance(s).')
+        if not self.tor_pool.start():
+            logging.warning('Not all the TOR instances are started.')
+
+        # Tokens for all the circuits are prepared simultaneously
+        for provider in self.anonymous_tokens:
+            provider.prepare()
+
+        failed_circuits = []
+        for circuit in self.api_proxy_pool:
+            if not self.init_token_anonymous(circuit):
+                logging.error("Can't initialize TOR circuit "
+                              + f'{circuit.index}. It is disabled.')
+                self.api_proxy_pool.disable(circuit)
+                failed_circuits.append(circuit)
+
+        if not self.api_proxy_pool.healthy_count():
+            logging.error('No TOR circuits available.')
             return False
 
-        self.add_auth_headers(access_token)
-        self.close_driver()
+        for circuit in failed_circuits:
+            self.start_refresh_circuit(circuit, new_token=True)
+
         return True
 
+    # Runs in a background thread while the circuit is disabled. The circuit
+    # gets a new token instead of the refused one (or the one it couldn't
+    # get at start), or just a new exit IP after network failures. Failed
+    # refreshes are retried with increasing delays until the circuit is
+    # enabled or the pool is closed.
+    def refresh_circuit(self, circuit: Circuit, refused_token: str=None,
+                        new_token: bool=False):
+        pool = self.api_proxy_pool
+
+        if refused_token:
+            # Refused anonymous token is useless with a new TOR IP
+            self.drop_cached_token(TOKEN_KEY_ANONYMOUS + str(circuit.index),
+                                   refused_token)
+            new_token = True
+
+        delay = CIRCUIT_REFRESH_DELAY
+        while True:
+            if new_token:
+                result = self.init_token_anonymous(circuit)
+            else:
+                result = self.start_tor(circuit.index, new_identity=True)
+                if result:
+                    self.isolate_circuit(circuit)
+
+            if result:
+                logging.info(f'TOR circuit {circuit.index} is enabled.')
+                pool.enable(circuit)
+                return
+
+            logging.error(f"Can't refresh TOR circuit {circuit.index}. "
+                          + f'Retrying in {delay} seconds.')
+            if pool.wait_closed(delay):
+                return
+            delay = min(2 * delay, CIRCUIT_REFRESH_MAX_DELAY)
+
+            # The token may be unavailable from the current exit IP
+            if new_token:
+                self.start_tor(circuit.index, new_identity=True)
+
+    def start_refresh_circuit(self, circuit: Circuit,
+                              refused_token: str=None,
+                              new_token: bool=False):
+        threading.Thread(target=self.refresh_circuit,
+                         args=(circuit, refused_token, new_token),
+                         daemon=True,
+                         name=f'circuit {circuit.index} refresh').start()
+
 ################################ INIT METHODS #################################
 
     def str_to_bool(self, value: str) -> bool:
@@ -404,6 +881,16 @@ class ScraperOLX():
         else:
             self.json_filename = json_filename
 
+        self.db_filename = parser.get('paths', 'db_filename',
+                                      fallback=DB_FILENAME)
+
+        self.parquet_filename = parser.get('paths', 'parquet_filename',
+                                           fallback='').strip()
+        if self.parquet_filename and not parquet_available():
+            logging.error('Parquet export requires pyarrow package. Install '
+                          'it or leave parquet_filename empty.')
+            return False
+
         image_dir = parser.get('paths', 'image_dir', fallback=None)
         if image_dir is None:
             logging.error("Can't read config value: image_dir.")
@@ -418,6 +905,24 @@ class ScraperOLX():
         else:
             self.save_images = self.str_to_bool(save_images)
 
+        try:
+            self.image_downloader.workers = parser.getint(
+                'general', 'image_workers', fallback=IMAGE_WORKERS)
+        except ValueError:
+            self.image_downloader.workers = 0
+
+        if self.image_downloader.workers < 1:
+            logging.error('Incorrect config value: image_workers.')
+            return False
+
+        async_images = parser.get('general', 'async_images', fallback='False')
+        self.image_downloader.use_async = self.str_to_bool(async_images)
+        if (self.image_downloader.use_async and
+                self.image_downloader.async_request is None):
+            logging.error('Asynchronous image downloads require the '
+                          'libraries from requirements-async.txt.')
+            return False
+
         restart_on_error = parser.get('general', 'restart_on_error',
                                       fallback=None)
         if restart_on_error is None:
@@ -433,6 +938,114 @@ class ScraperOLX():
         else:
             self.use_tor = self.str_to_bool(use_tor)
 
+        try:
+            self.tor_instances = parser.getint('general', 'tor_instances',
+                                               fallback=TOR_INSTANCES)
+        except ValueError:
+            self.tor_instances = 0
+
+        if self.tor_instances < 1:
+            logging.error('Incorrect config value: tor_instances.')
+            return False
+
+        # Configs of the versions before the SQLite store keep JSON Lines
+        storage = parser.get('general', 'storage', fallback=STORAGE_JSONL)
+        if storage.strip().lower() not in STORAGE_TYPES:
+            logging.error('Incorrect config value: storage.')
+            return False
+        else:
+            self.storage = storage.strip().lower()
+
+        listing_mode = parser.get('general', 'listing_mode',
+                                  fallback=LISTING_MODE_HTML)
+        if listing_mode.strip().lower() not in LISTING_MODES:
+            logging.error('Incorrect config value: listing_mode.')
+            return False
+        else:
+            self.listing_mode = listing_mode.strip().lower()
+
+        export_mode = parser.get('general', 'export_mode',
+                                 fallback=EXPORT_MODE_FULL)
+        if export_mode.strip().lower() not in EXPORT_MODES:
+            logging.error('Incorrect config value: export_mode.')
+            return False
+        else:
+            self.export_mode = export_mode.strip().lower()
+
+        try:
+            self.export_interval = parser.getfloat('general',
+                                                   'export_interval',
+                                                   fallback=EXPORT_INTERVAL)
+        except ValueError:
+            self.export_interval = -1
+
+        if self.export_interval < 0:
+            logging.error('Incorrect config value: export_interval.')
+            return False
+
+        try:
+            self.item_workers = parser.getint('general', 'item_workers',
+                                              fallback=ITEM_WORKERS)
+        except ValueError:
+            self.item_workers = 0
+
+        if self.item_workers < 1:
+            logging.error('Incorrect config value: item_workers.')
+            return False
+
+        try:
+            self.phone_quota.limit = parser.getint('general', 'phone_quota',
+                                                   fallback=PHONE_QUOTA)
+        except ValueError:
+            self.phone_quota.limit = 0
+
+        if self.phone_quota.limit < 1:
+            logging.error('Incorrect config value: phone_quota.')
+            return False
+
+        try:
+            phone_cache_ttl = parser.getfloat('general', 'phone_cache_ttl',
+                                              fallback=PHONE_CACHE_TTL)
+        except ValueError:
+            phone_cache_ttl = -1
+
+        if phone_cache_ttl < 0:
+            logging.error('Incorrect config value: phone_cache_ttl.')
+            return False
+        self.phone_cache_ttl = phone_cache_ttl * 60 * 60
+
+        defer_phones = parser.get('general', 'defer_phones', fallback='False')
+        self.defer_phones = self.str_to_bool(defer_phones)
+        if self.defer_phones and self.storage != STORAGE_SQLITE:
+            logging.error('Deferred phones resolving requires '
+                          f'storage = {STORAGE_SQLITE}.')
+            return False
+
+        try:
+            self.phone_workers = parser.getint('general', 'phone_workers',
+                                               fallback=PHONE_WORKERS)
+            self.phone_interval = parser.getfloat('general', 'phone_interval',
+                                                  fallback=PHONE_INTERVAL)
+        except ValueError:
+            logging.error('Incorrect config value: '
+                          'phone_workers or phone_interval.')
+            return False
+
+        if self.phone_workers < 1 or self.phone_interval < 0:
+            logging.error('Incorrect config value: '
+                          'phone_workers or phone_interval.')
+            return False
+
+        self.api_request.pool_maxsize = self.item_workers
+        self.api_request.reset_session()
+        self.image_request.pool_maxsize = self.image_downloader.workers
+        self.image_request.reset_session()
+        if self.image_downloader.async_request != None:
+            self.image_downloader.async_request.limit = (
+                self.image_downloader.workers)
+
+        self.create_tor_circuits()
+
         try:
             with open(SEARCH_LINKS_FILENAME, encoding='utf-8') as f:
                 lines = f.readlines()
@@ -450,8 +1063,40 @@ class ScraperOLX():
             logging.error('The search links list is empty.')
             return False
 
+        if self.storage == STORAGE_SQLITE:
+            self.item_store = SqliteItemStore(self.db_filename,
+                                              self.get_columns())
+        else:
+            self.item_store = JsonlItemStore(self.json_filename,
+                                             self.get_index_filename())
+
         return True
 
+    # Every TOR instance gets its own HTTP client and token provider
+    def create_tor_circuits(self):
+        if self.api_proxy_pool != None:
+            self.api_proxy_pool.close()
+        for provider in self.anonymous_tokens:
+            provider.stop()
+
+        self.tor_pool = TorPool(self.tor_instances)
+        self.api_proxy_pool = HttpRequestPool([
+            HttpRequest(sleep_time=SLEEP_TIME,
+                        proxies=tor_proxy.get_proxies())
+            for tor_proxy in self.tor_pool
+        ])
+        self.anonymous_tokens = [
+            TokenProvider(functools.partial(self.acquire_token_anonymous,
+                                            index),
+                          f'anonymous API token {index}',
+                          margin=TOKEN_REFRESH_MARGIN)
+            for index in range(self.tor_instances)
+        ]
+
+    # The index of scraped item ids is kept next to the JSON results file
+    def get_index_filename(self) -> str:
+        return os.path.splitext(self.json_filename)[0] + '.idx'
+
     def remove_if_exists(self, filename) -> bool:
         if os.path.exists(filename):
             try:
@@ -464,14 +1109,39 @@ class ScraperOLX():
 
         return True
 
+    # Phone workers save the account index while the main thread saves the
+    # page progress
     def save_progress(self) -> bool:
-        progress = {
-            'account_index': self.account_index,
-            'search_link_index': self.search_link_index,
-            'page': self.page,
-        }
+        with self.progress_lock:
+            progress = {
+                'account_index': self.account_index,
+                'search_link_index': self.search_link_index,
+                'page': self.page,
+            }
+
+            return save_items_json(progress, PROGRESS_FILENAME)
+
+    # The saved progress is useless without the results it belongs to, e.g.
+    # after the storage type has been changed
+    def check_results_exist(self) -> bool:
+        if not os.path.exists(PROGRESS_FILENAME):
+            return True
+
+        if self.storage == STORAGE_SQLITE:
+            store_filename = self.db_filename
+        else:
+            store_filename = self.json_filename
+
+        if (os.path.exists(store_filename) or
+                is_legacy_json(LEGACY_JSON_FILENAME)):
+            return True
 
-        return save_items_json(progress, PROGRESS_FILENAME)
+        logging.error(f'The progress file {PROGRESS_FILENAME} exists, but '
+                      + f'the results file {store_filename} is missing '
+                      + f'(storage = {self.storage}). Check the storage '
+                      + f'settings in {CONFIG_FILENAME} or start from the '
+                      + 'beginning with --reset-progress.')
+        return False
 
     def load_progress(self) -> bool:
         if os.path.exists(PROGRESS_FILENAME):
@@ -490,7 +1160,16 @@ class ScraperOLX():
                      'Starting the entire process from the beginning.')
 
         if (self.remove_if_exists(PROGRESS_FILENAME) and
-                self.remove_if_exists(self.json_filename)):
+                self.remove_if_exists(self.json_filename) and
+                self.remove_if_exists(LEGACY_JSON_FILENAME) and
+                self.remove_if_exists(self.get_index_filename()) and
+                self.remove_if_exists(self.db_filename) and
+                self.remove_if_exists(self.db_filename + '-wal') and
+                self.remove_if_exists(self.db_filename + '-shm')):
+            # The hashes of the exported items are kept, so the items
+            # scraped again without changes aren't exported again
+            if not self.export_state.reset_marks():
+                logging.warning("Can't reset the export state.")
             return True
         else:
             logging.error('Clearing progress failure.')
@@ -504,51 +1183,105 @@ class ScraperOLX():
 
         return True
 
-    def init_categories(self) -> bool:
+    def load_categories(self, use_cache=True) -> list:
+        self.categories_cache.load()
+        if not use_cache:
+            self.categories_cache.invalidate(CATEGORIES_CACHE_KEY)
+
+        categories = self.categories_cache.get(CATEGORIES_CACHE_KEY)
+        if categories != None:
+            logging.info('Categories list loaded from the cache.')
+            return categories
+
         logging.info('Retrieving categories list.')
         json = self.api_v2_request.get_json(API_CATEGORIES_URL)
         if json is None:
-            return False
+            return None
 
         if json.get('error'):
             logging.error('Error while API request: ' + str(json['error']))
-            return False
-
-        self.categories.clear()
+            return None
 
         try:
-            for category in json['data']:
-                self.categories.append({
+            categories = [
+                {
                     'id': category['id'],
                     'parent_id': category['parent_id'],
                     'name': category['name'],
-                })
+                }
+                for category in json['data']
+            ]
         except Exception:
             logging.exception('Error while parsing categories.')
+            return None
+
+        self.categories_cache.set(CATEGORIES_CACHE_KEY, categories,
+                                  ttl=CATEGORIES_CACHE_TTL)
+        if not self.categories_cache.save():
+            logging.warning("Can't save categories list to the cache.")
+
+        return categories
+
+    def init_categories(self, use_cache=True) -> bool:
+        categories = self.load_categories(use_cache)
+        if categories is None:
             return False
 
+        self.categories = {category['id']: category for category in categories}
+
+        # Breadcrumbs are built once for every category. Parent strings are
+        # reused, so each category is visited only once.
+        self.breadcrumbs.clear()
+        for category_id in self.categories:
+            self._build_breadcrumbs(category_id)
+
         return True
 
-    def get_category(self, category_id: int) -> dict:
-        for category in self.categories:
-            if category['id'] == category_id:
-                return category
+    def _build_breadcrumbs(self, category_id: int) -> str:
+        if category_id in self.breadcrumbs:
+            return self.breadcrumbs[category_id]
 
-        return None
+        # Walking up to the nearest ancestor with known breadcrumbs
+        path = []
+        breadcrumbs = None
+        while category_id not in self.breadcrumbs:
+            category = self.categories.get(category_id)
+            if category == None or category_id in path:
+                return None
+            path.append(category_id)
+            if category['parent_id'] == 0:
+                break
+            category_id = category['parent_id']
+        else:
+            breadcrumbs = self.breadcrumbs[category_id]
+
+        for category_id in reversed(path):
+            name = self.categories[category_id]['name']
+            if breadcrumbs is None:
+                breadcrumbs = name
+            else:
+                breadcrumbs = breadcrumbs + ' >> ' + name
+            self.breadcrumbs[category_id] = breadcrumbs
+
+        return breadcrumbs
+
+    def get_category(self, category_id: int) -> dict:
+        return self.categories.get(category_id)
 
+    # An unknown category may be newly added to OLX, while the cached list is
+    # outdated. The list is retrieved again once for every unknown category.
     def get_breadcrumbs(self, category_id: int) -> str:
-        category = self.get_category(category_id)
-        if category == None:
+        breadcrumbs = self.breadcrumbs.get(category_id)
+        if breadcrumbs != None or category_id in self.unknown_categories:
+            return breadcrumbs
+
+        self.unknown_categories.add(category_id)
+        logging.info(f'Unknown category (id = {category_id}). '
+                     'Reloading categories list.')
+        if not self.init_categories(use_cache=False):
             return None
-        breadcrumbs = [category['name']]
 
-        while category['parent_id'] != 0:
-            category = self.get_category(category['parent_id'])
-            if category == None:
-                return None
-            breadcrumbs.insert(0, category['name'])
-
-        return ' >> '.join(breadcrumbs)
+        return self.breadcrumbs.get(category_id)
 
     def init(self, reset_progress=False) -> bool:
         logging.info('Starting scraping process.')
@@ -565,13 +1298,39 @@ class ScraperOLX():
             except OSError:
                 logging.warning("Can't create images folder.")
 
-        if not(self.load_accounts() and
-               self.load_progress() and
-               self.init_token_personal() and
-               self.init_categories()):
+        self.tokens_cache.load()
+        self.tokens_cache.purge()
+
+        if not self.phone_quota.load():
+            logging.warning("Can't load the quota ledger.")
+
+        if self.phones_cache.load():
+            self.phones_cache.purge()
+        else:
+            logging.warning("Can't load the phones cache.")
+
+        if self.save_images and not self.image_downloader.open():
+            logging.warning("Can't open the image hashes database.")
+
+        if not(self.check_results_exist() and
+               self.load_accounts() and
+               self.load_progress()):
+            return False
+
+        self.next_account_index = self.account_index
+
+        # Offers and non-protected phones don't need the personal token. It's
+        # acquired by the first protected phone task after a quota reset.
+        if self.phone_quota.all_exhausted(self.get_logins()):
+            self.log_quota_exhausted()
+            logging.info('Continuing without personal API token.')
+        elif not self.init_token_personal():
+            return False
+
+        if not self.init_categories():
             return False
 
-        if self.use_tor and not self.init_token_anonymous():
+        if self.use_tor and not self.init_tor_circuits():
             return False
 
         return True
@@ -639,24 +1398,14 @@ class ScraperOLX():
 
 ############################## SCRAPING METHODS ###############################
 
-    def get_page_count(self, url: str) -> int:
-        html = self.request.get_html(url)
+    # Returns (page_count, item_ids) pair parsed from a single fetch of the
+    # listing page or None on failure
+    def get_listing_page(self, base_url: str, page: int) -> tuple:
+        html = self.request.get_html(f'{base_url}?page={page}')
         if not html:
             return None
 
-        soup = BeautifulSoup(html, 'lxml')
-
-        page_link_last = soup.find('a', attrs={'data-cy': 'page-link-last'})
-        if page_link_last:
-            try:
-                page_count = int(page_link_last.span.get_text())
-            except (AttributeError, ValueError):
-                logging.exception('Error while parsing page count.')
-                return None
-        else:
-            page_count = 1
-
-        return page_count
+        return parse_listing(html)
 
     # First page index is 1 (not 0), last page index is page count
     def get_item_ids(self, base_url: str, page: int) -> list:
@@ -664,54 +1413,207 @@ class ScraperOLX():
         if not html:
             return None
 
-        item_ids = []
+        return parse_item_ids(html)
+
+    # Returns offers list API parameters (category, region, city, query,
+    # filters, etc.) equivalent to the search link or None on failure
+    def get_search_params(self, base_url: str) -> dict:
+        url = urlparse(base_url)
+
+        json = self.api_request.get_json(
+            API_QUERY_PARAMS_URL.format(url.path.strip('/')))
+        if json is None:
+            return None
+
+        if json.get('error'):
+            logging.error('Error while API request: ' + str(json['error']))
+            return None
 
         try:
-            div_tags = (
-                BeautifulSoup(html, 'lxml')
-                .find('table', id='offers_table')
-                .find_all('div', class_='offer-wrapper')
-            )
+            params = {key: value for key, value in json['data'].items()
+                      if value not in (None, '')}
+        except Exception:
+            logging.exception('Error while parsing search parameters.')
+            return None
+
+        query_params = self.get_api_query_params(url.query)
+        if query_params is None:
+            return None
+        params.update(query_params)
+
+        return params
+
+    # Converts the search link query string to the offers list API
+    # parameters. Returns None if the query has unsupported keys: the API
+    # would silently ignore them and return more offers than the link.
+    def get_api_query_params(self, query: str) -> dict:
+        params = {}
+
+        for key, value in parse_qsl(query):
+            if key in API_IGNORED_QUERY_KEYS:
+                continue
+            elif key in API_QUERY_KEYS:
+                params[API_QUERY_KEYS[key]] = value
+            elif key.startswith(API_FILTER_QUERY_PREFIX) and ']' in key:
+                name, rest = key[len('search['):].split(']', 1)
+                params[name + rest] = value
+            else:
+                logging.error(f'Search link parameter {key} is not supported '
+                              + 'in API listing mode. Use listing_mode = '
+                              + f'{LISTING_MODE_HTML} for this link.')
+                return None
+
+        return params
+
+    # Returns (page_count, offers) pair retrieved with a single offers list
+    # API request or None on failure
+    def get_api_listing_page(self, search_params: dict, page: int) -> tuple:
+        params = dict(search_params)
+        params['offset'] = (page - 1) * API_PAGE_LIMIT
+        params['limit'] = API_PAGE_LIMIT
+
+        json = self.api_request.get_json(API_OFFERS_LIST_URL, params=params)
+        if json is None:
+            return None
+
+        if json.get('error'):
+            logging.error('Error while API request: ' + str(json['error']))
+            return None
 
-            for div_tag in div_tags:
-                item_ids.append(int(div_tag.table['data-id']))
-        except (AttributeError, KeyError, ValueError):
-            logging.exception('Error while parsing item ids.')
+        try:
+            offers = json['data']
+            total_count = json['metadata']['visible_total_count']
+        except Exception:
+            logging.exception('Error while parsing offers list.')
             return None
 
-        return item_ids
+        if total_count > API_MAX_OFFSETS:
+            if page == 1:
+                logging.warning(f'The search has {total_count} offers, but '
+                                + f'only the first {API_MAX_OFFSETS} are '
+                                + 'available via API. The results are '
+                                + 'truncated.')
+            total_count = API_MAX_OFFSETS
+
+        page_count = max(1, math.ceil(total_count / API_PAGE_LIMIT))
+        return page_count, offers
 
+    # Anonymous requests are spread across the TOR circuits: every attempt
+    # goes through the least loaded enabled circuit
     def scrape_phones(self, item_id: int, anonymous: bool = True) -> list:
         if anonymous:
             logging.info('Retrieving phones as non-protected '
                          + f'(item id = {item_id}).')
-            request = self.api_proxy_request
-            init_token = self.init_token_anonymous
         else:
             logging.info('Retrieving phones as protected '
                          + f'(item id = {item_id}).')
             request = self.api_request
             init_token = self.init_token_personal
 
+        # Failed anonymous requests are retried via the other circuits. Every
+        # circuit is disabled after CIRCUIT_MAX_FAILURES failures in a row.
+        network_failures = 0
+        forbidden_count = 0
+        max_network_failures = CIRCUIT_MAX_FAILURES * (
+            len(self.api_proxy_pool) if anonymous else 1)
+
         while True:
+            if anonymous:
+                circuit = self.api_proxy_pool.acquire(CIRCUIT_WAIT_TIMEOUT)
+                if circuit is None:
+                    logging.error('No TOR circuits available.')
+                    return None
+                request = circuit.request
+            else:
+                # The token isn't acquired at start when all the quotas are
+                # exhausted
+                if not self.personal_token_ready:
+                    with self.token_lock:
+                        if not (self.personal_token_ready or init_token()):
+                            logging.error('Error when generating new token.')
+                            return None
+                    continue
+
+                login = self.get_current_account()[0]
+                # No need to waste a request which is going to be refused
+                if not self.phone_quota.has_budget(login):
+                    logging.info(f'Phone quota is exhausted for {login}. '
+                                 'Switching to the next account.')
+                    with self.token_lock:
+                        if (self.get_current_account()[0] == login and
+                                not init_token()):
+                            logging.error('Error when generating new token.')
+                            return None
+                    continue
+
+            auth_header = request.headers.get('Authorization')
+
             json, status_code = request.get_json(
-                API_PHONES_URL.format(item_id), return_status_code=True)
+                API_PHONES_URL.format(item_id), return_status_code=True,
+                rate_limit_key=RATE_LIMIT_KEY_PHONES)
+
+            if anonymous:
+                # The circuit gets a new exit IP after repeated failures
+                if self.api_proxy_pool.release(
+                        circuit, success=(status_code != None)):
+                    self.start_refresh_circuit(circuit)
 
             if json is None:
-                if status_code is None:
+                if status_code is None and anonymous:
+                    network_failures += 1
+                    if network_failures >= max_network_failures:
+                        logging.error("Can't retrieve phones via TOR "
+                                      + f'circuits (item id = {item_id}).')
+                        return None
+
+                    logging.info('Retrying phones request via another '
+                                 + f'circuit (item id = {item_id}).')
+                    continue
+                elif status_code is None:
                     return None
 
-                if status_code == requests.codes.too_many_requests:
+                # Unauthorized means the token has expired or is revoked
+                token_refused = status_code in [
+                    requests.codes.too_many_requests,
+                    requests.codes.unauthorized,
+                ]
+
+                if token_refused and anonymous:
+                    logging.info("Can't retrieve phones: access disallowed. "
+                                 'New access token required '
+                                 + f'(circuit {circuit.index}).')
+                    # The token may be already replaced by another phone
+                    # worker. Meanwhile the other circuits are used.
+                    if (request.headers.get('Authorization') == auth_header
+                            and self.api_proxy_pool.disable(circuit)):
+                        self.start_refresh_circuit(
+                            circuit, refused_token=auth_header.split(' ')[-1])
+                    continue
+                elif token_refused:
                     logging.info("Can't retrieve phones: access disallowed. "
                                  'New access token required.')
-                    if not init_token():
-                        logging.error('Error when generating new token.')
-                        return None
+                    with self.token_lock:
+                        # The token may be already replaced by another
+                        # phone worker
+                        if request.headers.get('Authorization') != auth_header:
+                            continue
+
+                        if status_code == requests.codes.too_many_requests:
+                            self.phone_quota.exhaust(login)
+                        else:
+                            self.drop_cached_token(TOKEN_KEY_PERSONAL + login,
+                                                   auth_header.split(' ')[-1])
+                        if not init_token():
+                            logging.error('Error when generating new token.')
+                            return None
                     continue
-                elif status_code == requests.codes.forbidden and not anonymous:
-                    logging.info('Maybe too many requests. Waiting for '
-                                 + f'{WAIT_FORBIDDEN_RETRY} seconds.')
-                    time.sleep(WAIT_FORBIDDEN_RETRY)
+                elif (status_code == requests.codes.forbidden and
+                        not anonymous and
+                        forbidden_count < PHONE_FORBIDDEN_RETRIES):
+                    # The rate limiter pauses the following requests
+                    forbidden_count += 1
+                    logging.info('Maybe too many requests. Retrying with '
+                                 'lower request rate.')
                     continue
                 else:
                     return None
@@ -729,17 +1631,79 @@ class ScraperOLX():
                                   + f'Item id = {item_id}.')
                 return None
             else:
+                if not anonymous:
+                    self.phone_quota.consume(login)
                 return phones
 
         return None
 
+    def normalize_phones(self, phones: list) -> list:
+        phones = [clean_phone(phone) for phone in phones]
+
+        for i in range(len(phones)):
+            if len(phones[i]) == 10:
+                phones[i] = '+38' + phones[i]
+            elif len(phones[i]) == 12 and phones[i].startswith('380'):
+                phones[i] = '+' + phones[i]
+
+        return phones
+
+    # Zero TTL turns the phones cache off
+    def get_cached_phones(self, user_id: int) -> list:
+        if self.phone_cache_ttl > 0:
+            return self.phones_cache.get(user_id)
+
+        return None
+
+    def save_phones_cache(self, force=False) -> bool:
+        if not self.phones_cache.modified:
+            return True
+
+        if (not force and time.monotonic() - self.phones_cache_saved
+                < PHONES_CACHE_SAVE_INTERVAL):
+            return True
+
+        self.phones_cache_saved = time.monotonic()
+        return self.phones_cache.save()
+
+    # Seller phones are looked up in the cache before the phones API request
+    def get_phones(self, item_id: int, user_id: int,
+                   anonymous: bool = True) -> list:
+        phones = self.get_cached_phones(user_id)
+        if phones != None:
+            logging.info('Phones are taken from the cache '
+                         + f'(item id = {item_id}, user id = {user_id}).')
+            return phones
+
+        phones = self.scrape_phones(item_id, anonymous=anonymous)
+        if phones is None:
+            return None
+
+        phones = self.normalize_phones(phones)
+        if self.phone_cache_ttl > 0:
+            self.phones_cache.set(user_id, phones, ttl=self.phone_cache_ttl)
+        return phones
+
     def format_date_time(self, date_time_text: str) -> str:
         return date_time_text.split('+')[0].replace('T', ' ')
 
-    def scrape_item(self, item_id: int) -> dict:
-        logging.info(f'Scraping item (id = {item_id}).')
+    # Returns (json, status_code) pair of the offers API response
+    def fetch_item(self, item_id: int) -> tuple:
+        return self.api_request.get_json(
+            API_OFFERS_URL.format(item_id), return_status_code=True)
 
-        item = {
+    # Offer responses for the whole page are retrieved concurrently, the
+    # result list preserves the order of item_ids
+    def fetch_items(self, item_ids: list) -> list:
+        if not item_ids:
+            return []
+
+        workers = min(self.item_workers, len(item_ids))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self.fetch_item, item_ids))
+
+    def create_item(self, item_id: int) -> dict:
+        return {
             'id': item_id,
             'url': '',
             'title': '',
@@ -760,8 +1724,14 @@ class ScraperOLX():
             'user_last_seen': '',
         }
 
-        json, status_code = self.api_request.get_json(
-            API_OFFERS_URL.format(item_id), return_status_code=True)
+    # The response parameter is a result of fetch_item() if it has been
+    # already retrieved
+    def scrape_item(self, item_id: int, response: tuple = None) -> dict:
+        logging.info(f'Scraping item (id = {item_id}).')
+
+        if response is None:
+            response = self.fetch_item(item_id)
+        json, status_code = response
 
         if (status_code and ((status_code == requests.codes.gone) or
                              (status_code == requests.codes.not_found))):
@@ -775,37 +1745,48 @@ class ScraperOLX():
             logging.error('Error while API request: ' + str(json['error']))
             return None
 
+        if not isinstance(json.get('data'), dict):
+            logging.error('Error while parsing item JSON: no offer data.')
+            return None
+
+        return self.parse_item(item_id, json['data'])
+
+    # Maps the offer dict (as returned both by the single offer API and the
+    # offers list API) to the item fields
+    def parse_item(self, item_id: int, offer: dict) -> dict:
+        item = self.create_item(item_id)
+
         try:
-            item['url'] = json['data']['url']
-            item['title'] = json['data']['title']
+            item['url'] = offer['url']
+            item['title'] = offer['title']
 
-            breadcrumbs = self.get_breadcrumbs(json['data']['category']['id'])
+            breadcrumbs = self.get_breadcrumbs(offer['category']['id'])
             if breadcrumbs is None:
                 logging.error("Error while building 'breadcrumbs' string.")
                 return None
             item['category'] = breadcrumbs
 
             item['last_refresh_time'] = self.format_date_time(
-                json['data']['last_refresh_time'])
+                offer['last_refresh_time'])
 
             item['created_time'] = self.format_date_time(
-                json['data']['created_time'])
+                offer['created_time'])
 
-            for param in json['data']['params']:
+            for param in offer['params']:
                 if param['key'] == 'price':
                     item['price'] = param['value']['label']
                 elif param['key'] == 'state':
                     item['state'] = param['value']['label']
 
-            item['description'] = (json['data']['description']
+            item['description'] = (offer['description']
                                    .replace('\n', '').replace('\r', ''))
 
-            item['city'] = json['data']['location']['city']['name']
-            item['region'] = json['data']['location']['region']['name']
+            item['city'] = offer['location']['city']['name']
+            item['region'] = offer['location']['region']['name']
 
-            if json['data']['photos']:
+            if offer['photos']:
                 photo_urls = []
-                for photo in json['data']['photos']:
+                for photo in offer['photos']:
                     photo_url = (photo['link']
                                  .replace('{width}', str(photo['width']))
                                  .replace('{height}', str(photo['height'])))
@@ -813,8 +1794,10 @@ class ScraperOLX():
 
                 item['photos'] = ', '.join(photo_urls)
 
+                # The images are downloaded in the background, the page
+                # waits for them before its progress is saved
                 if self.save_images:
-                    logging.info(f'Saving item images (id = {item_id}).')
+                    logging.info(f'Queueing item images (id = {item_id}).')
 
                     images_path = os.path.join(self.image_dir, str(item_id))
 
@@ -826,99 +1809,234 @@ class ScraperOLX():
                                           f'for item with id = {item_id}.')
 
                     if os.path.exists(images_path):
-                        for index, photo in enumerate(json['data']['photos']):
+                        for index, photo in enumerate(offer['photos']):
                             photo_url = photo_urls[index]
                             photo_filename = os.path.join(
                                 images_path, photo['filename'] + '.jpg')
-                            self.request.save_image(photo_url, photo_filename)
+                            self.image_downloader.submit(photo_url,
+                                                         photo_filename)
 
-            item['contact_name'] = json['data']['contact']['name']
+            item['contact_name'] = offer['contact']['name']
 
-            if json['data']['contact']['phone']:
+            if offer['contact']['phone']:
                 anonymous = False
-                if not json['data']['protect_phone'] and self.use_tor:
+                if not offer['protect_phone'] and self.use_tor:
                     anonymous = True
-                phones = self.scrape_phones(item_id, anonymous=anonymous)
+                user_id = offer['user']['id']
+
+                if self.defer_phones:
+                    phones = self.get_cached_phones(user_id)
+                    if phones is None:
+                        self.phone_tasks.append({
+                            'item_id': item_id,
+                            'user_id': user_id,
+                            'anonymous': anonymous,
+                            'created_time': item['created_time'],
+                        })
+                else:
+                    phones = self.get_phones(item_id, user_id,
+                                             anonymous=anonymous)
+                    if phones is None:
+                        return None
 
                 if phones is None:
-                    return None
-
-                for i in range(len(phones)):
-                    phones[i] = clean_phone(phones[i])
-                    if len(phones[i]) == 10:
-                        phones[i] = '+38' + phones[i]
-                    elif len(phones[i]) == 12 and phones[i].startswith('380'):
-                        phones[i] = '+' + phones[i]
-
-                item['contact_phones'] = ', '.join(phones)
+                    item['contact_phones'] = PHONES_PENDING
+                else:
+                    item['contact_phones'] = ', '.join(phones)
 
-            item['user_id'] = json['data']['user']['id']
-            item['user_name'] = json['data']['user']['name']
+            item['user_id'] = offer['user']['id']
+            item['user_name'] = offer['user']['name']
             item['user_created'] = self.format_date_time(
-                json['data']['user']['created'])
+                offer['user']['created'])
             item['user_last_seen'] = self.format_date_time(
-                json['data']['user']['last_seen'])
+                offer['user']['last_seen'])
         except Exception:
             logging.exception('Error while parsing item JSON.')
             return None
 
         return item
 
-    def item_is_scraped(self, items: list, item_id: int) -> bool:
-        for item in items:
-            if item['id'] == item_id:
-                logging.info(f'The item with id = {item_id} '
-                             'is already scraped. Skipping.')
-                return True
+    def item_is_scraped(self, item_id: int) -> bool:
+        if self.item_store.contains(item_id):
+            logging.info(f'The item with id = {item_id} '
+                         'is already scraped. Skipping.')
+            return True
         return False
 
-    def scrape_all_items(self) -> list:
-        if os.path.exists(self.json_filename):
-            logging.info('Loading previous scraping result.')
-            items = load_items_json(self.json_filename)
+    # Items scraped by the old versions are imported into the empty store.
+    # The JSON Lines store converts the file itself if it's the same file.
+    def import_legacy_results(self) -> bool:
+        if (len(self.item_store) or
+                not is_legacy_json(LEGACY_JSON_FILENAME) or
+                (self.storage == STORAGE_JSONL and os.path.abspath(
+                    self.json_filename) == os.path.abspath(
+                        LEGACY_JSON_FILENAME))):
+            return True
+
+        logging.info('Importing previous scraping results from the file '
+                     + f'{LEGACY_JSON_FILENAME}.')
+        try:
+            items = load_items_json(LEGACY_JSON_FILENAME)
+        except ValueError:
+            logging.exception("Can't import the file "
+                              + f'{LEGACY_JSON_FILENAME}.')
+            return False
+
+        if not isinstance(items, list) or not self.item_store.append(items):
+            logging.error("Can't import the file "
+                          + f'{LEGACY_JSON_FILENAME}.')
+            return False
+
+        logging.info(f'Items imported: {len(items)}.')
+        return True
+
+    # Returns the item store with all the scraped items
+    def scrape_all_items(self):
+        logging.info('Loading previous scraping result.')
+
+        if not (self.item_store.open() and
+                self.import_legacy_results()):
+            return None
+
+        if not self.defer_phones:
+            items = self.scrape_search_links()
+            if not self.save_phones_cache(force=True):
+                logging.warning("Can't save the phones cache.")
+            return items
+
+        self.start_phone_workers()
+        items = self.scrape_search_links()
+        self.stop_phone_workers(drain=(items is not None))
+
+        # The phones resolved while draining are cached too
+        if not self.save_phones_cache(force=True):
+            logging.warning("Can't save the phones cache.")
+
+        pending_count = self.item_store.count_phone_tasks()
+        if pending_count:
+            logging.warning(f'Phones are still pending for {pending_count} '
+                            'items. They will be retrieved on the next run.')
+
+        return items
+
+    # Scrapes the items of a listing page retrieved in HTML mode
+    def scrape_page_item_ids(self, item_ids: list) -> list:
+        item_ids = [
+            item_id for item_id in dict.fromkeys(item_ids)
+            if not self.item_is_scraped(item_id)
+        ]
+
+        responses = self.fetch_items(item_ids)
+        items = []
+
+        for item_id, response in zip(item_ids, responses):
+            item = self.scrape_item(item_id, response)
+            if item is None:
+                return None
+            if not item:
+                continue
+
+            items.append(item)
+
+        return items
+
+    # Scrapes the items of a listing page retrieved in API mode: the offers
+    # are complete, so no more requests are needed except phones
+    def scrape_page_offers(self, offers: list) -> list:
+        items = []
+        item_ids = set()
+
+        for offer in offers:
+            item_id = offer.get('id')
+            if item_id in item_ids or self.item_is_scraped(item_id):
+                continue
+            item_ids.add(item_id)
+
+            logging.info(f'Scraping item (id = {item_id}).')
+            item = self.parse_item(item_id, offer)
+            if item is None:
+                return None
+
+            items.append(item)
+
+        return items
+
+    # Returns (page_count, page_content) pair for the page of the search
+    # link: item ids in HTML mode or offers in API mode
+    def get_search_page(self, base_url: str, search_params: dict,
+                        page: int) -> tuple:
+        if self.listing_mode == LISTING_MODE_API:
+            return self.get_api_listing_page(search_params, page)
         else:
-            items = []
+            return self.get_listing_page(base_url, page)
 
+    # Returns the item store with all the scraped items
+    def scrape_search_links(self):
         while self.search_link_index < len(self.search_links):
             base_url = self.search_links[self.search_link_index]
             logging.info(f'Scraping search request: {base_url}.')
 
-            page_count = self.get_page_count(base_url)
-            if page_count == None:
+            search_params = None
+            if self.listing_mode == LISTING_MODE_API:
+                search_params = self.get_search_params(base_url)
+                if search_params == None:
+                    return None
+
+            # The first page gives both the page count and its content
+            listing_page = self.get_search_page(base_url, search_params, 1)
+            if listing_page == None:
                 return None
+            page_count, first_page_content = listing_page
             logging.info(f'Total page count: {page_count}.')
 
             while self.page <= page_count:
                 logging.info('Scraping items '
                              + f'for page {self.page} of {page_count}.')
 
-                item_ids = self.get_item_ids(base_url, self.page)
-                if item_ids == None:
+                if self.page == 1:
+                    page_content = first_page_content
+                elif self.listing_mode == LISTING_MODE_API:
+                    listing_page = self.get_api_listing_page(search_params,
+                                                             self.page)
+                    if listing_page == None:
+                        return None
+                    page_content = listing_page[1]
+                else:
+                    page_content = self.get_item_ids(base_url, self.page)
+                if page_content == None:
                     return None
 
-                for item_id in item_ids:
-                    if self.item_is_scraped(items, item_id):
-                        continue
-                    item = self.scrape_item(item_id)
-                    if item is None:
-                        return None
-                    if not item:
-                        continue
+                self.phone_tasks = []
+                if self.listing_mode == LISTING_MODE_API:
+                    items = self.scrape_page_offers(page_content)
+                else:
+                    items = self.scrape_page_item_ids(page_content)
+                if items == None:
+                    return None
 
-                    items.append(item)
+                if self.save_images:
+                    failures = self.image_downloader.wait()
+                    if failures:
+                        logging.warning(f"Can't save {failures} images "
+                                        + f'for page {self.page}.')
 
-                logging.info(f'Items currently scraped: {len(items)}.')
-                if save_items_json(items, self.json_filename):
+                if (self.item_store.append(items, self.phone_tasks) and
+                        self.save_phones_cache()):
                     saving_result = 'OK'
                 else:
                     saving_result = 'FAILURE'
                 logging.info('Saving intermediate results for page '
                              + f'{self.page}: {saving_result}.')
+                logging.info('Items currently scraped: '
+                             + f'{len(self.item_store)}.')
 
                 self.page += 1
                 if not self.save_progress():
                     logging.warning("Can't save the next page number.")
 
+                if self.export_is_due() and not self.export_results():
+                    logging.warning("Can't export intermediate results.")
+
                 if self.should_close:
                     return None
 
@@ -927,13 +2045,227 @@ class ScraperOLX():
             if not self.save_progress():
                 logging.warning("Can't save the next category index.")
 
-        return items
+        return self.item_store
+
+############################ DEFERRED PHONE STAGE #############################
+
+    def start_phone_workers(self):
+        self.stop_phone_workers()
+
+        logging.info(f'Starting {self.phone_workers} phone worker(s). '
+                     + 'Phone requests queued: '
+                     + f'{self.item_store.count_phone_tasks()}.')
+
+        self.phone_workers_stop.clear()
+        self.phone_queue_draining = False
+        self.phone_threads = [
+            threading.Thread(target=self.phone_worker, daemon=True,
+                             name=f'phone worker {index}')
+            for index in range(self.phone_workers)
+        ]
+        for thread in self.phone_threads:
+            thread.start()
+
+    # With drain=True the workers finish all the available tasks first
+    def stop_phone_workers(self, drain: bool=False):
+        if not self.phone_threads:
+            return
+
+        if drain:
+            logging.info('Waiting for pending phone requests completion.')
+            self.phone_queue_draining = True
+        else:
+            self.phone_workers_stop.set()
+
+        for thread in self.phone_threads:
+            thread.join()
+
+        self.phone_threads = []
+        self.phone_tasks_active.clear()
 
-    def get_columns(self, item: dict) -> list:
-        return list(item.keys())
+    def wait_phone_interval(self):
+        with self.phone_lock:
+            now = time.time()
+            wait_time = self.phone_next_time - now
+            self.phone_next_time = (max(now, self.phone_next_time)
+                                    + self.phone_interval)
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def claim_phone_task(self) -> dict:
+        # Protected phones can't be retrieved until any quota reset
+        anonymous_only = self.phone_quota.all_exhausted(self.get_logins())
+
+        with self.phone_lock:
+            task = self.item_store.get_phone_task(
+                exclude_ids=list(self.phone_tasks_active),
+                anonymous_only=anonymous_only)
+            if task != None:
+                self.phone_tasks_active.add(task['item_id'])
+
+        return task
+
+    # Returns the time to wait for a postponed task or None if there are no
+    # tasks the worker can claim later
+    def get_phone_task_wait_time(self) -> float:
+        anonymous_only = self.phone_quota.all_exhausted(self.get_logins())
+
+        with self.phone_lock:
+            next_time = self.item_store.get_next_phone_task_time(
+                exclude_ids=list(self.phone_tasks_active),
+                anonymous_only=anonymous_only)
+
+        if next_time is None:
+            return None
+
+        return max(0, next_time - time.time())
+
+    def resolve_phone_task(self, task: dict):
+        item_id = task['item_id']
+
+        self.wait_phone_interval()
+        phones = self.get_phones(item_id, task['user_id'],
+                                 anonymous=task['anonymous'])
+
+        if phones != None:
+            contact_phones = ', '.join(phones)
+        elif task['attempts'] + 1 >= PHONE_MAX_ATTEMPTS:
+            logging.error(f"Can't retrieve phones (item id = {item_id}). "
+                          'Giving up.')
+            contact_phones = 'N/A'
+        else:
+            logging.warning(f"Can't retrieve phones (item id = {item_id}). "
+                            'The request is postponed.')
+            contact_phones = None
+
+        if contact_phones is None:
+            self.item_store.postpone_phone_task(
+                item_id, PHONE_RETRY_DELAY * 2 ** task['attempts'])
+        elif not self.item_store.resolve_phone_task(item_id, contact_phones):
+            logging.error(f"Can't save phones (item id = {item_id}).")
+
+    def phone_worker(self):
+        while not self.phone_workers_stop.is_set():
+            task = self.claim_phone_task()
+            if task is None:
+                wait_time = PHONE_QUEUE_POLL
+                # Postponed tasks are waited for while draining
+                if self.phone_queue_draining:
+                    task_wait_time = self.get_phone_task_wait_time()
+                    if task_wait_time is None:
+                        break
+                    wait_time = min(wait_time, task_wait_time)
+                self.phone_workers_stop.wait(wait_time)
+                continue
+
+            try:
+                self.resolve_phone_task(task)
+            except Exception:
+                logging.exception('Error while resolving phones '
+                                  + f'(item id = {task["item_id"]}).')
+            finally:
+                with self.phone_lock:
+                    self.phone_tasks_active.discard(task['item_id'])
+
+    def get_columns(self) -> list:
+        return list(self.create_item(0).keys())
+
+    def get_delta_filename(self, filename: str, suffix: str) -> str:
+        root, ext = os.path.splitext(filename)
+        return root + suffix + ext
+
+    # Saves the items to all the result files. The items must be iterable
+    # several times. Non-empty suffix is added to the file names.
+    def save_results(self, items, suffix: str='') -> bool:
+        # JSON Lines store is the full JSON output itself
+        if ((suffix or self.storage != STORAGE_JSONL) and
+                not save_items_jsonl(items, self.get_delta_filename(
+                    self.json_filename, suffix))):
+            return False
+
+        if not save_items_csv(items, self.get_columns(),
+                              self.get_delta_filename(self.csv_filename,
+                                                      suffix)):
+            return False
+
+        if not save_items_xlsx(items, self.get_columns(),
+                               self.get_delta_filename(self.xlsx_filename,
+                                                       suffix),
+                               column_widths=XLSX_COLUMN_WIDTHS,
+                               column_types=XLSX_COLUMN_TYPES):
+            return False
+
+        if self.parquet_filename and not save_items_parquet(
+                items, self.get_columns(),
+                self.get_delta_filename(self.parquet_filename, suffix),
+                dictionary_columns=PARQUET_DICTIONARY_COLUMNS,
+                timestamp_columns=PARQUET_TIMESTAMP_COLUMNS,
+                integer_columns=PARQUET_INTEGER_COLUMNS):
+            return False
+
+        return True
+
+    # Saves the items added or changed since the previous delta export to
+    # new timestamped files. The export state is saved only after all the
+    # files are written, so a failed export is repeated next time.
+    def export_delta(self) -> bool:
+        mark = self.item_store.get_mark()
+        if mark is None:
+            return False
+
+        export_mark = self.export_state.get_mark(self.storage)
+        if export_mark != None and export_mark > mark:
+            logging.warning('The results were rewritten since the previous '
+                            'export. Checking all the items for changes.')
+            export_mark = None
+
+        if export_mark == mark:
+            logging.info('No items changed since the previous export.')
+            return True
+
+        # The items changed during the export get into the next delta
+        items = ItemRange(self.item_store, export_mark, mark)
+        changed_count = self.export_state.collect_changes(items)
+        if changed_count is None:
+            return False
+
+        if changed_count:
+            logging.info(f'Items changed since the previous export: '
+                         + f'{changed_count}.')
+            export_number = self.export_state.next_export_number()
+            if export_number is None:
+                return False
+
+            suffix = time.strftime(DELTA_SUFFIX_FORMAT) + f'_{export_number}'
+            if not self.save_results(ChangedItems(items, self.export_state),
+                                     suffix):
+                return False
+        else:
+            logging.info('No items changed since the previous export.')
+
+        return self.export_state.commit(self.storage, mark)
+
+    def export_results(self) -> bool:
+        logging.info(f'Exporting the results ({self.export_mode} mode).')
+        self.last_export_time = time.monotonic()
+
+        if self.export_mode == EXPORT_MODE_DELTA:
+            result = self.export_delta()
+        else:
+            result = self.save_results(self.item_store)
+
+        logging.info('Exporting complete.' if result else 'Exporting failure.')
+        return result
+
+    def export_is_due(self) -> bool:
+        return (self.export_interval > 0 and time.monotonic()
+                - self.last_export_time >= self.export_interval)
 
     def _execute_scraping(self) -> bool:
         try:
+            self.last_export_time = time.monotonic()
+
             items = self.scrape_all_items()
             if self.should_close:
                 logging.info('Scraping process stopped by user.')
@@ -945,13 +2277,7 @@ class ScraperOLX():
 
             logging.info('Scraping process complete. Now saving the results.')
 
-            if not save_items_csv(items, self.get_columns(items[0]),
-                                  self.csv_filename):
-                logging.error(FATAL_ERROR_STR)
-                return False
-
-            if not save_items_xlsx(items, self.get_columns(items[0]),
-                                   self.xlsx_filename):
+            if not self.export_results():
                 logging.error(FATAL_ERROR_STR)
                 return False
 
@@ -974,6 +2300,25 @@ class ScraperOLX():
         else:
             return self._execute_scraping()
 
+    def compact_results(self) -> bool:
+        logging.info('Compacting scraping results.')
+
+        if not self.load_config():
+            return False
+
+        if not self.item_store.compact():
+            logging.error('Compacting failure.')
+            return False
+
+        # Compacting rewrites the JSON Lines file, so its offsets change
+        if (self.storage == STORAGE_JSONL and
+                not self.export_state.reset_marks()):
+            logging.warning("Can't reset the export state.")
+
+        logging.info('Compacting complete. '
+                     + f'Items in the results file: {len(self.item_store)}.')
+        return True
+
 ############################# PROGRAM ENTRY POINT #############################
 
 def main():
@@ -983,6 +2328,11 @@ def main():
         scraper.check_accounts()
         return
 
+    if '--compact-results' in sys.argv:
+        scraper.compact_results()
+        scraper.cleanup()
+        return
+
     if '--reset-progress' in sys.argv:
         reset_progress = True
     else:
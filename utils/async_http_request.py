@@ -0,0 +1,403 @@
+import os
+import re
+import json
+import random
+import asyncio
+import logging
+import copy
+from urllib.parse import urlparse
+
+# Optional dependencies, see requirements-async.txt
+import aiohttp
+from aiohttp_socks import ProxyConnector
+
+from .tor_proxy import TorProxy
+from .free_proxy import FreeProxy
+from .rate_limiter import get_rate_limiter
+from .http_request import (
+    TIMEOUT,
+    MAX_RETRIES,
+    SLEEP_TIME,
+    HEADERS,
+    ICANHAZIP_URL,
+    STREAM_CHUNK_SIZE,
+    BACKOFF_BASE,
+    BACKOFF_MAX,
+    RETRY_STATUS_CODES,
+    RETRY_AFTER_STATUS_CODES,
+    PROXY_TYPE_FREE,
+    PROXY_TYPE_TOR,
+    retry_budget,
+    parse_retry_after,
+)
+
+# Maximum number of simultaneously open connections (0 means no limit)
+CONNECTION_LIMIT = 100
+
+# Maximum number of simultaneously open connections to a single host
+CONNECTION_LIMIT_PER_HOST = 0
+
+# Polling period of a rate limiter without free slots (seconds)
+RATE_LIMIT_POLL = 0.05
+
+# Response data read completely before the connection is released
+class AsyncResponse():
+    def __init__(self, url: str, status_code: int, content: bytes,
+                 encoding: str):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.encoding = encoding or 'utf-8'
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding, errors='replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+# Asyncio counterpart of HttpRequest: all the request methods are coroutines.
+# One aiohttp session is kept for the current proxy (either HTTP or SOCKS),
+# so a lot of requests may be in flight on a single event loop. The retry
+# policy is the same: exponential backoff with jitter, the global retry
+# budget, Retry-After and the shared per-host rate limiters.
+class AsyncHttpRequest():
+    def __init__(self, headers: dict=HEADERS, max_retries: int=MAX_RETRIES,
+                 timeout: float=TIMEOUT, sleep_time: float=SLEEP_TIME,
+                 proxies=None, proxy_test_url: str=None,
+                 limit: int=CONNECTION_LIMIT,
+                 limit_per_host: int=CONNECTION_LIMIT_PER_HOST,
+                 rate_limit: bool=False, backoff_base: float=BACKOFF_BASE,
+                 backoff_max: float=BACKOFF_MAX):
+        # These attributes may be changed directly
+        self.headers = copy.deepcopy(headers)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.sleep_time = sleep_time
+        # Adaptive per-host rate limiting shared with other instances
+        self.rate_limit = rate_limit
+        self.proxies = proxies
+        self.proxy_test_url = proxy_test_url
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+
+        # Don't change these atrributes from outside the class instance
+        self.tor_proxy = TorProxy()
+        self.free_proxy = FreeProxy()
+        self.proxy_index = -1
+        self.proxy = None
+        self.proxy_initialized = False
+        self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def _get_next_proxy(self):
+        if self.proxies == None:
+            return None
+        elif isinstance(self.proxies, dict):
+            return self.proxies
+        elif isinstance(self.proxies, list):
+            self.proxy_index += 1
+            self.proxy_index = self.proxy_index % len(self.proxies)
+            return self.proxies[self.proxy_index]
+        elif self.proxies == PROXY_TYPE_FREE:
+            logging.info('Searching for free proxies.')
+            # FreeProxy is blocking, so it shouldn't stall the event loop
+            loop = asyncio.get_running_loop()
+            proxy = await loop.run_in_executor(
+                None, self.free_proxy.get_proxy, self.proxy_test_url)
+            return {'http': proxy, 'https': proxy}
+        elif self.proxies == PROXY_TYPE_TOR:
+            logging.info('Requesting new TOR identity.')
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.tor_proxy.new_identity)
+            return self.tor_proxy.get_proxies()
+
+    def _get_proxy_url(self, url: str) -> str:
+        if not self.proxy:
+            return None
+
+        return self.proxy.get(urlparse(url).scheme) or self.proxy.get('https')
+
+    def _create_session(self, proxy_url: str) -> aiohttp.ClientSession:
+        if proxy_url:
+            # SOCKS and HTTP proxies are both handled by the connector
+            connector = ProxyConnector.from_url(
+                proxy_url, limit=self.limit,
+                limit_per_host=self.limit_per_host)
+        else:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit, limit_per_host=self.limit_per_host)
+
+        # The timeout limits connecting and every read, not the whole
+        # response, so large bodies are streamed even via slow proxies
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=None,
+                                          sock_connect=self.timeout,
+                                          sock_read=self.timeout),
+            cookie_jar=aiohttp.DummyCookieJar())
+
+    async def _get_session(self, url: str) -> aiohttp.ClientSession:
+        if not self.proxy_initialized:
+            self.proxy = await self._get_next_proxy()
+            self.proxy_initialized = True
+
+        if self.session == None or self.session.closed:
+            self.session = self._create_session(self._get_proxy_url(url))
+
+        return self.session
+
+    async def close(self):
+        if self.session != None and not self.session.closed:
+            try:
+                await self.session.close()
+            except Exception:
+                logging.exception('Error while closing HTTP session.')
+
+        self.session = None
+
+    async def rotate_proxy(self):
+        logging.info('Changing proxy (if possible).')
+        self.proxy = await self._get_next_proxy()
+        self.proxy_initialized = True
+        await self.close()
+        logging.info('Now using IP: ' + str(await self.get_ip()))
+
+    # Non-idempotent requests (POST) are retried only if the connection to
+    # the server has not been established, so the request was never sent
+    def _is_retriable_error(self, error: Exception, idempotent: bool) -> bool:
+        return idempotent or isinstance(error, aiohttp.ClientConnectorError)
+
+    def _get_backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max,
+                                     self.backoff_base * 2 ** attempt))
+
+    # RateLimiter.acquire() blocks the thread, so the slot is polled
+    async def _acquire_limiter(self, limiter) -> float:
+        while True:
+            start_time, wait_time = limiter.try_acquire()
+            if start_time != None:
+                return start_time
+
+            await asyncio.sleep(RATE_LIMIT_POLL if wait_time is None
+                                else max(wait_time, RATE_LIMIT_POLL))
+
+    async def _read_response(self,
+                             r: aiohttp.ClientResponse) -> AsyncResponse:
+        return AsyncResponse(str(r.url), r.status, await r.read(),
+                             r.get_encoding())
+
+    # The handler coroutine gets the successful response while it's open
+    # and returns the request result. Broken response bodies are retried
+    # like connection errors.
+    async def _request(self, method: str, **args):
+        return_status_code = args['return_status_code']
+        del args['return_status_code']
+        idempotent = args['idempotent']
+        del args['idempotent']
+        rate_limit_key = args.pop('rate_limit_key', None)
+        handler = args.pop('handler', None) or self._read_response
+
+        args['headers'] = self.headers
+
+        limiter = None
+        if self.rate_limit:
+            limiter = get_rate_limiter(rate_limit_key
+                                       or urlparse(args['url']).hostname)
+
+        retry_budget.deposit()
+        status_code = None
+
+        for attempt in range(0, self.max_retries):
+            if limiter != None:
+                limiter_time = await self._acquire_limiter(limiter)
+
+            session = await self._get_session(args['url'])
+            response_status = None
+            error = None
+            try:
+                async with session.request(method, **args) as r:
+                    response_status = r.status
+                    retry_after = parse_retry_after(
+                        r.headers.get('Retry-After'))
+                    if r.status == 200:
+                        result = await handler(r)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            finally:
+                if limiter != None:
+                    limiter.release(limiter_time, response_status)
+
+            if error != None:
+                if not self._is_retriable_error(error, idempotent):
+                    break
+                delay = self._get_backoff(attempt)
+            else:
+                status_code = response_status
+                if idempotent and (status_code in RETRY_STATUS_CODES or
+                                   (status_code in RETRY_AFTER_STATUS_CODES
+                                    and retry_after != None)):
+                    logging.warning(f'Error {status_code} '
+                                    + f'while accessing {args["url"]}.')
+
+                    delay = self._get_backoff(attempt)
+                    if retry_after != None:
+                        if retry_after > self.backoff_max:
+                            break
+                        delay = max(delay, retry_after)
+                else:
+                    if limiter is None:
+                        await asyncio.sleep(self.sleep_time)
+
+                    if status_code != 200:
+                        logging.error(f'Error {status_code} '
+                                      + f'while accessing {args["url"]}.')
+                        return ((None, status_code) if return_status_code
+                                else None)
+
+                    return ((result, status_code) if return_status_code
+                            else result)
+
+            if attempt == self.max_retries - 1:
+                break
+
+            if not retry_budget.withdraw():
+                logging.warning('Retry budget is exhausted. Not retrying '
+                                + f'the request to {args["url"]}.')
+                break
+
+            await asyncio.sleep(delay)
+
+        logging.error("Can't execute HTTP request while accessing "
+                      + args['url'])
+        return (None, status_code) if return_status_code else None
+
+    # The rate limit key replaces the host name as the rate limiter key
+    async def get(self, url: str, params: dict = None,
+                  return_status_code=False, rate_limit_key: str=None):
+        args = {
+            'url': url,
+            'params': params,
+            'return_status_code': return_status_code,
+            'idempotent': True,
+            'rate_limit_key': rate_limit_key,
+        }
+        return await self._request('GET', **args)
+
+    async def post(self, url: str, data: dict = None,
+                   return_status_code=False):
+        args = {
+            'url': url,
+            'data': data,
+            'return_status_code': return_status_code,
+            'idempotent': False,
+        }
+        return await self._request('POST', **args)
+
+    async def get_ip(self) -> str:
+        ip = await self.get(ICANHAZIP_URL)
+        if ip == None:
+            return None
+
+        return ip.text.strip()
+
+    async def get_html(self, url: str, params: dict = None,
+                       return_status_code=False) -> str:
+        r, status_code = await self.get(url, params=params,
+                                        return_status_code=True)
+        if r == None:
+            return (None, status_code) if return_status_code else None
+
+        return (r.text, status_code) if return_status_code else r.text
+
+    async def get_json(self, url: str, params: dict=None,
+                       return_status_code=False,
+                       rate_limit_key: str=None) -> dict:
+        r, status_code = await self.get(url, params=params,
+                                        return_status_code=True,
+                                        rate_limit_key=rate_limit_key)
+        if r == None:
+            return (None, status_code) if return_status_code else None
+
+        try:
+            data = r.json()
+        except Exception:
+            logging.exception(f'Error while getting JSON from URL [{url}].')
+            return (None, status_code) if return_status_code else None
+
+        return (data, status_code) if return_status_code else data
+
+    async def check_url(self, url: str) -> bool:
+        r = await self.get(url)
+        if r == None:
+            return False
+
+        # Soft checking for redirect
+        base_url_part = re.sub(r'^www\.', '', urlparse(url.lower()).netloc)
+        base_url_part = base_url_part.split('.')[0]
+        if base_url_part not in r.url.lower():
+            return False
+
+        return True
+
+    # Retrieve an image from URL and save it to a file. The image is
+    # streamed to a temporary file which is renamed when complete, like
+    # HttpRequest.save_image() does. The file operations run in the default
+    # executor, so they don't block the event loop.
+    async def save_image(self, url: str, filename: str) -> bool:
+        loop = asyncio.get_running_loop()
+        temp_filename = filename + '.part'
+
+        async def write_content(r: aiohttp.ClientResponse) -> bool:
+            f = await loop.run_in_executor(None, open, temp_filename, 'wb')
+            try:
+                async for chunk in r.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    await loop.run_in_executor(None, f.write, chunk)
+            finally:
+                await loop.run_in_executor(None, f.close)
+
+            await loop.run_in_executor(None, os.replace, temp_filename,
+                                       filename)
+            return True
+
+        args = {
+            'url': url,
+            'return_status_code': False,
+            'idempotent': True,
+            'handler': write_content,
+        }
+
+        try:
+            if await self._request('GET', **args):
+                return True
+        except OSError:
+            logging.exception(f"Can't save the image to the file {filename}.")
+        else:
+            logging.error(f'Failure while retrieving an image from {url}.')
+
+        try:
+            await loop.run_in_executor(None, os.remove, temp_filename)
+        except OSError:
+            pass
+
+        return False
+
+# For testing
+async def _main():
+    async with AsyncHttpRequest() as request:
+        ips = await asyncio.gather(*[request.get_ip() for i in range(5)])
+        print(ips)
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main())
+
+if __name__ == '__main__':
+    main()
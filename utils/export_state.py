@@ -0,0 +1,200 @@
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+
+from .id_index import IdIndex
+
+# Exported item hashes are looked up in batches of this size
+EXPORT_STATE_BATCH_SIZE = 500
+
+# State of the delta exports kept apart from the scraping progress and the
+# item store, so it survives resetting the progress: the store mark of the
+# last export and the content hash of every exported item. Items scraped
+# again without changes don't get into the next delta.
+#
+# An export is done in three steps: collect_changes() finds the changed
+# items, the files are written with the items filtered by ChangedItems, and
+# commit() stores the new hashes and the mark.
+class ExportState():
+    def __init__(self, filename: str):
+        self.filename = filename
+
+        # Don't change these atrributes from outside the class instance
+        self.connection = None
+        self.changed_ids = IdIndex() # Items of the export in progress
+        self.lock = threading.RLock()
+
+    def __del__(self):
+        self.close()
+
+    def __contains__(self, item_id: int) -> bool:
+        return item_id in self.changed_ids
+
+    def open(self) -> bool:
+        with self.lock:
+            self.close()
+
+            try:
+                self.connection = sqlite3.connect(self.filename,
+                                                  check_same_thread=False)
+                with self.connection:
+                    self.connection.execute(
+                        'CREATE TABLE IF NOT EXISTS exported '
+                        '(id INTEGER PRIMARY KEY, hash TEXT)')
+                    self.connection.execute(
+                        'CREATE TABLE IF NOT EXISTS pending '
+                        '(id INTEGER PRIMARY KEY, hash TEXT)')
+                    self.connection.execute(
+                        'CREATE TABLE IF NOT EXISTS marks '
+                        '(storage TEXT PRIMARY KEY, mark INTEGER)')
+                    self.connection.execute(
+                        'CREATE TABLE IF NOT EXISTS exports '
+                        '(number INTEGER PRIMARY KEY AUTOINCREMENT, '
+                        'created REAL)')
+            except sqlite3.Error:
+                logging.exception(
+                    f"Can't open the database {self.filename}.")
+                self.close()
+                return False
+
+            return True
+
+    def close(self):
+        with self.lock:
+            if self.connection != None:
+                self.connection.close()
+                self.connection = None
+
+    def _execute_transaction(self, statements: list) -> bool:
+        with self.lock:
+            if self.connection == None and not self.open():
+                return False
+
+            try:
+                with self.connection:
+                    for sql, parameters in statements:
+                        self.connection.executemany(sql, parameters)
+            except sqlite3.Error:
+                logging.exception(
+                    f"Can't write to the database {self.filename}.")
+                return False
+
+            return True
+
+    # Returns the store mark of the last export, None if there is no mark
+    # for the storage type (e.g. the progress has been reset)
+    def get_mark(self, storage: str) -> int:
+        with self.lock:
+            if self.connection == None and not self.open():
+                return None
+
+            try:
+                row = self.connection.execute(
+                    'SELECT mark FROM marks WHERE storage = ?',
+                    (storage,)).fetchone()
+            except sqlite3.Error:
+                logging.exception(
+                    f"Can't query the database {self.filename}.")
+                return None
+
+            return row[0] if row else None
+
+    # Returns the next number of the delta export or None on failure. The
+    # numbers are never reused, even after resetting the marks, so the
+    # files of different exports never get the same name.
+    def next_export_number(self) -> int:
+        with self.lock:
+            if self.connection == None and not self.open():
+                return None
+
+            try:
+                with self.connection:
+                    cursor = self.connection.execute(
+                        'INSERT INTO exports (created) VALUES (?)',
+                        (time.time(),))
+            except sqlite3.Error:
+                logging.exception(
+                    f"Can't write to the database {self.filename}.")
+                return None
+
+            return cursor.lastrowid
+
+    # The marks of a new or rewritten store are meaningless, the hashes of
+    # the exported items are kept
+    def reset_marks(self) -> bool:
+        return self._execute_transaction([('DELETE FROM marks', [()])])
+
+    def get_hash(self, item: dict) -> str:
+        data = json.dumps(item, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    # Compares the items with the exported ones. Returns the count of new and
+    # changed items or None on failure.
+    def collect_changes(self, items) -> int:
+        self.changed_ids.clear()
+        if not self._execute_transaction([('DELETE FROM pending', [()])]):
+            return None
+
+        batch = []
+        for item in items:
+            batch.append((item['id'], self.get_hash(item)))
+            if len(batch) >= EXPORT_STATE_BATCH_SIZE:
+                if not self._collect_batch(batch):
+                    return None
+                batch = []
+
+        if batch and not self._collect_batch(batch):
+            return None
+
+        return len(self.changed_ids)
+
+    def _collect_batch(self, batch: list) -> bool:
+        placeholders = ', '.join('?' * len(batch))
+
+        with self.lock:
+            try:
+                exported = dict(self.connection.execute(
+                    f'SELECT id, hash FROM exported WHERE id IN '
+                    f'({placeholders})', [item_id for item_id, _ in batch]))
+            except sqlite3.Error:
+                logging.exception(
+                    f"Can't query the database {self.filename}.")
+                return False
+
+        changed = [(item_id, item_hash) for item_id, item_hash in batch
+                   if exported.get(item_id) != item_hash]
+        for item_id, item_hash in changed:
+            self.changed_ids.add(item_id)
+
+        return self._execute_transaction([
+            ('INSERT OR REPLACE INTO pending (id, hash) VALUES (?, ?)',
+             changed),
+        ])
+
+    # Stores the hashes of the exported items along with the store mark
+    def commit(self, storage: str, mark: int) -> bool:
+        if not self._execute_transaction([
+                ('INSERT OR REPLACE INTO exported (id, hash) '
+                 'SELECT id, hash FROM pending', [()]),
+                ('DELETE FROM pending', [()]),
+                ('INSERT OR REPLACE INTO marks (storage, mark) '
+                 'VALUES (?, ?)', [(storage, mark)]),
+        ]):
+            return False
+
+        self.changed_ids.clear()
+        return True
+
+# Re-iterable view of the items found changed by ExportState.collect_changes()
+class ChangedItems():
+    def __init__(self, items, export_state: ExportState):
+        self.items = items
+        self.export_state = export_state
+
+    def __iter__(self):
+        for item in self.items:
+            if item['id'] in self.export_state:
+                yield item
@@ -1,9 +1,13 @@
 import logging
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from bs4 import BeautifulSoup
 
+from .json_cache import JsonCache
+
 FREE_PROXY_HOST = 'https://free-proxy-list.net'
 HTTP_BIN_HOST = 'https://httpbin.org/ip'
 TIMEOUT = 5
@@ -12,32 +16,50 @@ PROXY_TYPE_ANONYMOUS = 'anonymous'
 PROXY_TYPE_ELITE = 'elite proxy'
 PROXY_TYPE_ANY = [PROXY_TYPE_ANONYMOUS, PROXY_TYPE_ELITE]
 
-USED_PROXIES_MAX = 1000
-
 TEST_ATTEMPTS = 5
 TEST_DELAY = 2
 TEST_URL = 'https://github.com/'
 TEST_URL = 'https://zoon.ru/'
 
-class FreeProxy():
-    def __init__(self, proxy_type=PROXY_TYPE_ANONYMOUS):
-        # key: proxy URL; value: times the proxy has been used
-        self.used_proxies = {}
-        self.proxy_type = proxy_type
+# The file where the proxy pool with the proxy scores is kept between runs
+PROXY_POOL_FILENAME = 'proxies.json'
 
-    def get_sorted_proxies(self) -> list:
-        parsed_proxies = self.parse_proxies()
-        if parsed_proxies == None:
-            return None
+# Number of proxies validated concurrently
+VALIDATION_WORKERS = 32
+
+# Smoothing factor of the latency and success rate moving averages
+SCORE_ALPHA = 0.3
+
+# Proxies with lower success rate are considered dead
+MIN_SUCCESS_RATE = 0.5
+
+# The proxy list is parsed again when there are less live proxies in the pool
+MIN_LIVE_PROXIES = 5
+
+# Period of the background re-checking of the pool (seconds)
+RECHECK_INTERVAL = 5 * 60
 
-        sorted_proxies = [
-            {'name': proxy, 'count': self.used_proxies.get(proxy, 0)}
-            for proxy in parsed_proxies
-        ]
+# Proxies are dropped from the pool after this time since the last
+# successful check (seconds)
+PROXY_TTL = 24 * 60 * 60
 
-        sorted_proxies.sort(key=lambda proxy: proxy['count'])
+# Keeps a pool of free proxies scored by the measured latency and success
+# rate (exponentially weighted moving averages). Candidates are validated
+# concurrently, the pool is re-checked in a background thread after the
+# first get_proxy() call, so the best live proxy is returned instantly.
+class FreeProxy():
+    def __init__(self, proxy_type=PROXY_TYPE_ANONYMOUS,
+                 filename: str=PROXY_POOL_FILENAME):
+        self.proxy_type = proxy_type
 
-        return [proxy['name'] for proxy in sorted_proxies]
+        # Don't change these atrributes from outside the class instance
+        # key: proxy URL; value: dict with 'latency' and 'success' keys
+        self.pool = JsonCache(filename)
+        self.pool_loaded = False
+        self.test_url = None
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.thread = None
 
     def parse_proxies(self) -> list:
         proxies = []
@@ -61,72 +83,184 @@ class FreeProxy():
             r = requests.get(HTTP_BIN_HOST, proxies={'https': proxy},
                              timeout=TIMEOUT)
         except Exception:
-            logging.info(f"Can't access {HTTP_BIN_HOST} via proxy {proxy}.")
+            logging.debug(f"Can't access {HTTP_BIN_HOST} via proxy {proxy}.")
         else:
             try:
                 ip = r.json()['origin']
             except Exception:
-                logging.exception(f'Failure while accessing {HTTP_BIN_HOST} '
-                                  + f'via proxy {proxy}: incorrest respond.')
+                logging.debug(f'Failure while accessing {HTTP_BIN_HOST} '
+                              + f'via proxy {proxy}: incorrest respond.')
             else:
-                logging.info(f'Access via proxy was granted. New IP: {ip}.')
+                logging.debug(f'Access via proxy was granted. New IP: {ip}.')
                 return True
 
         return False
 
     def _execute_test(self, test_url: str, proxy: str):
-        logging.info(f'Starting test sequence for {test_url}')
+        logging.debug(f'Starting test sequence for {test_url}')
 
         for i in range(TEST_ATTEMPTS):
             try:
                 r = requests.get(test_url, proxies={'https': proxy},
                                  timeout=TIMEOUT)
             except Exception:
-                logging.info(f"Can't access {test_url} via proxy {proxy}.")
+                logging.debug(f"Can't access {test_url} via proxy {proxy}.")
                 return False
 
             if r.status_code != requests.codes.ok:
-                logging.info(f'Error {r.status_code} '
-                             + f'while accessing {test_url}')
+                logging.debug(f'Error {r.status_code} '
+                              + f'while accessing {test_url}')
                 return False
 
             time.sleep(TEST_DELAY)
 
-        logging.info(f'Testing result for {test_url}: OK.')
+        logging.debug(f'Testing result for {test_url}: OK.')
         return True
 
-    def get_proxy(self, test_url: str=None) -> str:
-        proxies = self.get_sorted_proxies()
-        if not proxies:
+    # Returns the proxy latency (seconds) or None if the proxy doesn't work
+    def check_proxy(self, proxy: str, test_url: str=None) -> float:
+        start_time = time.monotonic()
+        if not self.proxy_is_valid(proxy):
+            return None
+        latency = time.monotonic() - start_time
+
+        if test_url and not self._execute_test(test_url, proxy):
             return None
 
-        for proxy in proxies:
-            if self.proxy_is_valid(proxy):
-                if test_url and (not self._execute_test(test_url, proxy)):
-                    continue
+        return latency
+
+    def load_pool(self):
+        with self.lock:
+            if self.pool_loaded:
+                return
+
+            if not self.pool.load():
+                logging.warning("Can't load the proxy pool.")
+            self.pool.purge()
+            self.pool_loaded = True
+
+    # Updates the proxy score with the result of a check or a request made
+    # via the proxy. The latency is required for successful results.
+    def report(self, proxy: str, success: bool, latency: float=None):
+        with self.lock:
+            score = self.pool.get(proxy)
+            expires = self.pool.get_expires(proxy)
+
+            if score is None:
+                if not success:
+                    return
+                score = {'latency': latency, 'success': 1.0}
+            else:
+                score = dict(score)
+                score['success'] += SCORE_ALPHA * (success - score['success'])
+                if success:
+                    score['latency'] += (SCORE_ALPHA
+                                         * (latency - score['latency']))
 
-                self.used_proxies[proxy] = self.used_proxies.get(proxy, 0) + 1
+            if success:
+                expires = time.time() + PROXY_TTL
+            self.pool.set(proxy, score, expires=expires)
 
-                # For really long-time runs
-                for key in list(self.used_proxies.keys())[USED_PROXIES_MAX:]:
-                    del self.used_proxies[key]
+    # Checks all the given proxies concurrently. Returns the count of live
+    # proxies in the pool afterwards.
+    def validate_proxies(self, proxies: list, test_url: str=None) -> int:
+        if proxies:
+            logging.info(f'Validating {len(proxies)} free proxies.')
+
+            workers = min(VALIDATION_WORKERS, len(proxies))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                latencies = executor.map(
+                    lambda proxy: self.check_proxy(proxy, test_url), proxies)
+
+                for proxy, latency in zip(proxies, latencies):
+                    self.report(proxy, latency != None, latency)
+
+            if not self.pool.save():
+                logging.warning("Can't save the proxy pool.")
+
+        live_count = len(self.get_live_proxies())
+        logging.info(f'Live proxies in the pool: {live_count}.')
+        return live_count
+
+    # Re-checks the pool proxies along with the freshly parsed ones
+    def refresh(self, test_url: str=None) -> int:
+        logging.info('Searching for free proxies.')
+
+        proxies = [proxy for proxy, score in self.pool.items()]
+        parsed_proxies = self.parse_proxies()
+        if parsed_proxies != None:
+            proxies += [proxy for proxy in parsed_proxies
+                        if proxy not in proxies]
+
+        return self.validate_proxies(proxies, test_url)
+
+    # Returns the live proxies, the best ones first
+    def get_live_proxies(self) -> list:
+        scores = [(proxy, score) for proxy, score in self.pool.items()
+                  if score['success'] >= MIN_SUCCESS_RATE]
+        scores.sort(key=lambda item: (item[1]['success']
+                                      / max(item[1]['latency'], 0.001)),
+                    reverse=True)
+
+        return [proxy for proxy, score in scores]
+
+    def _run(self):
+        while not self.stopped.wait(RECHECK_INTERVAL):
+            try:
+                proxies = [proxy for proxy, score in self.pool.items()]
+                if (self.validate_proxies(proxies, self.test_url)
+                        < MIN_LIVE_PROXIES):
+                    self.refresh(self.test_url)
+            except Exception:
+                logging.exception('Error while re-checking free proxies.')
+
+    def start(self):
+        with self.lock:
+            if self.thread != None and self.thread.is_alive():
+                return
+
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run, daemon=True,
+                                           name='free proxy checker')
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    # Returns the best live proxy except the excluded one (e.g. the proxy
+    # which is being rotated). The pool is filled on the first call only.
+    def get_proxy(self, test_url: str=None, exclude: str=None) -> str:
+        self.load_pool()
+        if test_url:
+            self.test_url = test_url
+
+        proxies = [proxy for proxy in self.get_live_proxies()
+                   if proxy != exclude]
+        if not proxies:
+            self.refresh(self.test_url)
+            proxies = [proxy for proxy in self.get_live_proxies()
+                       if proxy != exclude]
 
-                return proxy
+        self.start()
 
-        return None
+        return proxies[0] if proxies else None
 
 # For testing
 def main():
     logging.basicConfig(level=logging.INFO)
     proxy = FreeProxy()
+    proxy_url = None
     while True:
-        proxy_url = proxy.get_proxy(test_url=TEST_URL)
+        proxy_url = proxy.get_proxy(test_url=TEST_URL, exclude=proxy_url)
         print(f'Good proxy: {proxy_url}')
         try:
+            start_time = time.monotonic()
             r = requests.get(TEST_URL, proxies={'https': proxy_url},
                              timeout=TIMEOUT)
+            proxy.report(proxy_url, True, time.monotonic() - start_time)
             print(f'Status code: {r.status_code}')
         except Exception:
+            proxy.report(proxy_url, False)
             logging.exception(f'Failure while accessing {TEST_URL}')
 
 if __name__ == '__main__':
@@ -1,13 +1,21 @@
+import os
 import re
 import time
+import random
 import logging
 import copy
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from email.utils import parsedate_to_datetime
 from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 
-from .tor_proxy import TorProxy, TOR_SOCKS_PROXIES
+from .tor_proxy import TorProxy
 from .free_proxy import FreeProxy
+from .rate_limiter import get_rate_limiter
 
 # Timeout for web server response (seconds)
 TIMEOUT = 5
@@ -15,7 +23,32 @@ TIMEOUT = 5
 # Maximum retries count for executing request if an error occurred
 MAX_RETRIES = 3
 
-# The delay after executing an HTTP request (seconds)
+# Delays between retries grow exponentially: a random delay (full jitter)
+# up to BACKOFF_BASE * 2 ** attempt, but not longer than BACKOFF_MAX. A longer
+# Retry-After response header makes the request fail without retries.
+# (seconds)
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+
+# Size of the chunks the streamed response bodies are written in (bytes)
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Transient server errors retried for idempotent requests
+RETRY_STATUS_CODES = [502, 503, 504]
+
+# Throttling responses retried for idempotent requests only if the server
+# tells when to retry (Retry-After header)
+RETRY_AFTER_STATUS_CODES = [429]
+
+# Global retry budget: retries are allowed for up to RETRY_BUDGET_RATIO of
+# all the requests plus RETRY_BUDGET_MIN_RATE retries per second, so a
+# degraded server doesn't get multiplied load
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_MIN_RATE = 1
+RETRY_BUDGET_CAPACITY = 10
+
+# The delay after executing an HTTP request (seconds). It's not used when
+# the requests are rate limited.
 # SLEEP_TIME = 1
 SLEEP_TIME = 0.5
 
@@ -26,29 +59,141 @@ HEADERS = {
     'Accept': '*/*',
 }
 
+# Number of per-host connection pools cached by a session
+POOL_CONNECTIONS = 10
+
+# Maximum number of keep-alive connections kept open to a single host
+POOL_MAXSIZE = 10
+
+# Consecutive failed requests after which a pool circuit is disabled
+CIRCUIT_MAX_FAILURES = 3
+
 ICANHAZIP_URL = 'http://icanhazip.com'
 
 PROXY_TYPE_FREE = 'free'
 PROXY_TYPE_TOR = 'tor'
 
+# Returns Retry-After header value in seconds (None if it's missing)
+def parse_retry_after(retry_after: str) -> float:
+    if not retry_after:
+        return None
+
+    try:
+        return max(0, float(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        return max(0, parsedate_to_datetime(retry_after).timestamp()
+                   - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# Retry budget shared by all the HTTP clients in the process
+class RetryBudget():
+    def __init__(self, ratio: float=RETRY_BUDGET_RATIO,
+                 min_rate: float=RETRY_BUDGET_MIN_RATE,
+                 capacity: float=RETRY_BUDGET_CAPACITY):
+        self.ratio = ratio
+        self.min_rate = min_rate
+        self.capacity = capacity
+
+        # Don't change these atrributes from outside the class instance
+        self.balance = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, amount: float=0):
+        now = time.monotonic()
+        self.balance = min(self.capacity,
+                           self.balance + amount
+                           + (now - self.updated) * self.min_rate)
+        self.updated = now
+
+    # Called once per request (not per attempt)
+    def deposit(self):
+        with self.lock:
+            self._refill(self.ratio)
+
+    # Returns False if the retry is not allowed
+    def withdraw(self) -> bool:
+        with self.lock:
+            self._refill()
+            if self.balance < 1:
+                return False
+
+            self.balance -= 1
+            return True
+
+retry_budget = RetryBudget()
+
 class HttpRequest():
     def __init__(self, headers: dict=HEADERS, max_retries: int=MAX_RETRIES,
                  timeout: float=TIMEOUT, sleep_time: float=SLEEP_TIME,
-                 proxies=None, proxy_test_url: str=None):
+                 proxies=None, proxy_test_url: str=None,
+                 pool_connections: int=POOL_CONNECTIONS,
+                 pool_maxsize: int=POOL_MAXSIZE, rate_limit: bool=False,
+                 backoff_base: float=BACKOFF_BASE,
+                 backoff_max: float=BACKOFF_MAX):
         # These attributes may be changed directly
         self.headers = copy.deepcopy(headers)
         self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
         self.timeout = timeout
         self.sleep_time = sleep_time
+        # Adaptive per-host rate limiting shared with other instances
+        self.rate_limit = rate_limit
         self.proxies = proxies
         self.proxy_test_url = proxy_test_url
 
         # Don't change these atrributes from outside the class instance
         self.tor_proxy = TorProxy()
         self.free_proxy = FreeProxy()
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.session = self._create_session()
         self.proxy_index = -1
+        self.proxy = None
         self.proxy = self._get_next_proxy()
 
+    def __del__(self):
+        free_proxy = getattr(self, 'free_proxy', None)
+        if free_proxy != None:
+            free_proxy.stop()
+
+        self.close()
+
+    # The session keeps connections alive between requests. Connection pools
+    # are keyed by scheme, host and port, and each proxy URL gets its own
+    # pool manager, so rotating proxies never reuses a foreign connection.
+    def _create_session(self) -> requests.Session:
+        session = requests.Session()
+
+        # Stay stateless like module-level requests.get(): cookies set by
+        # the server must not leak into subsequent requests
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                              pool_maxsize=self.pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        return session
+
+    # Drops all pooled connections (e.g. after the proxy has been restarted)
+    def reset_session(self):
+        self.close()
+        self.session = self._create_session()
+
+    def close(self):
+        session = getattr(self, 'session', None)
+        if session != None:
+            try:
+                session.close()
+            except Exception:
+                logging.exception('Error while closing HTTP session.')
+
     def _get_next_proxy(self):
         if self.proxies == None:
             return None
@@ -59,52 +204,156 @@ class HttpRequest():
             self.proxy_index = self.proxy_index % len(self.proxies)
             return self.proxies[self.proxy_index]
         elif self.proxies == PROXY_TYPE_FREE:
-            logging.info('Searching for free proxies.')
-            proxy = self.free_proxy.get_proxy(self.proxy_test_url)
+            # The best proxy of the scored pool except the current one
+            proxy = self.free_proxy.get_proxy(
+                self.proxy_test_url,
+                exclude=self.proxy['https'] if self.proxy else None)
             return {'http': proxy, 'https': proxy}
         elif self.proxies == PROXY_TYPE_TOR:
-            logging.info('Starting TOR.')
-            self.tor_proxy.restart()
-            return TOR_SOCKS_PROXIES
+            logging.info('Requesting new TOR identity.')
+            self.tor_proxy.new_identity()
+            return self.tor_proxy.get_proxies()
+
+    def set_proxies(self, proxies):
+        self.proxies = proxies
+        self.proxy_index = -1
+        self.proxy = self._get_next_proxy()
+        self.reset_session()
 
     def rotate_proxy(self):
         logging.info('Changing proxy (if possible).')
         self.proxy = self._get_next_proxy()
+        self.reset_session()
         logging.info('Now using IP: ' + self.get_ip())
 
+    # Request results are used for scoring the free proxies
+    def _report_proxy(self, success: bool, latency: float=None):
+        if (self.proxies == PROXY_TYPE_FREE and self.proxy and
+                self.proxy['https']):
+            self.free_proxy.report(self.proxy['https'], success, latency)
+
+    # Non-idempotent requests (POST) are retried only if the connection to
+    # the server has not been established, so the request was never sent.
+    # Broken response bodies are retried for idempotent requests.
+    def _is_retriable_error(self, error: Exception, idempotent: bool) -> bool:
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+
+        if isinstance(error, (requests.exceptions.ChunkedEncodingError,
+                              requests.exceptions.ContentDecodingError)):
+            return idempotent
+
+        if isinstance(error, requests.exceptions.ConnectionError):
+            if idempotent:
+                return True
+            reason = None
+            if error.args:
+                reason = getattr(error.args[0], 'reason', None)
+            return isinstance(reason, NewConnectionError)
+
+        return idempotent and isinstance(error, requests.exceptions.Timeout)
+
+    def _get_retry_after(self, r: requests.Response) -> float:
+        return parse_retry_after(r.headers.get('Retry-After'))
+
+    def _get_backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max,
+                                     self.backoff_base * 2 ** attempt))
+
     def _request(self, func, **args) -> requests.Response:
         return_status_code = args['return_status_code']
         del args['return_status_code']
+        idempotent = args['idempotent']
+        del args['idempotent']
+        rate_limit_key = args.pop('rate_limit_key', None)
 
         args['headers'] = self.headers
         args['timeout'] = self.timeout
         args['proxies'] = self.proxy
+
+        limiter = None
+        if self.rate_limit:
+            limiter = get_rate_limiter(rate_limit_key
+                                       or urlparse(args['url']).hostname)
+
+        retry_budget.deposit()
+        status_code = None
+
         for attempt in range(0, self.max_retries):
+            if limiter != None:
+                limiter_time = limiter.acquire()
+
+            start_time = time.monotonic()
             try:
                 r = func(**args)
-            except requests.exceptions.RequestException:
-                time.sleep(self.sleep_time)
+            except requests.exceptions.RequestException as e:
+                self._report_proxy(False)
+                if limiter != None:
+                    limiter.release(limiter_time)
+
+                if not self._is_retriable_error(e, idempotent):
+                    break
+                delay = self._get_backoff(attempt)
             else:
-                time.sleep(self.sleep_time)
-
-                if r.status_code != requests.codes.ok:
-                    logging.error(f'Error {r.status_code} '
-                                  + f'while accessing {args["url"]}.')
-                    return (None, r.status_code) if return_status_code else None
-
-                return (r, r.status_code) if return_status_code else r
+                self._report_proxy(True, time.monotonic() - start_time)
+                if limiter != None:
+                    limiter.release(limiter_time, r.status_code)
+
+                status_code = r.status_code
+                retry_after = self._get_retry_after(r)
+                if idempotent and (status_code in RETRY_STATUS_CODES or
+                                   (status_code in RETRY_AFTER_STATUS_CODES
+                                    and retry_after != None)):
+                    logging.warning(f'Error {status_code} '
+                                    + f'while accessing {args["url"]}.')
+                    r.close() # Releases the connection of a streamed response
+
+                    delay = self._get_backoff(attempt)
+                    if retry_after != None:
+                        if retry_after > self.backoff_max:
+                            break
+                        delay = max(delay, retry_after)
+                else:
+                    if limiter is None:
+                        time.sleep(self.sleep_time)
+
+                    if status_code != requests.codes.ok:
+                        logging.error(f'Error {status_code} '
+                                      + f'while accessing {args["url"]}.')
+                        r.close()
+                        return ((None, status_code) if return_status_code
+                                else None)
+
+                    return (r, status_code) if return_status_code else r
+
+            if attempt == self.max_retries - 1:
+                break
+
+            if not retry_budget.withdraw():
+                logging.warning('Retry budget is exhausted. Not retrying '
+                                + f'the request to {args["url"]}.')
+                break
+
+            time.sleep(delay)
 
         logging.error("Can't execute HTTP request while accessing "
                       + args['url'])
-        return (None, None) if return_status_code else None
+        return (None, status_code) if return_status_code else None
 
-    def get(self, url: str, params: dict = None, return_status_code=False):
+    # The body of a streamed response is read on demand, the response must
+    # be closed afterwards. The rate limit key replaces the host name as the
+    # rate limiter key.
+    def get(self, url: str, params: dict = None, return_status_code=False,
+            stream=False, rate_limit_key: str=None):
         args = {
             'url': url,
             'params': params,
+            'stream': stream,
             'return_status_code': return_status_code,
+            'idempotent': True,
+            'rate_limit_key': rate_limit_key,
         }
-        func = requests.get
+        func = self.session.get
         return self._request(func=func, **args)
 
     def post(self, url: str, data: dict = None, return_status_code=False):
@@ -112,8 +361,9 @@ class HttpRequest():
             'url': url,
             'data': data,
             'return_status_code': return_status_code,
+            'idempotent': False,
         }
-        func = requests.post
+        func = self.session.post
         return self._request(func=func, **args)
 
     def get_ip(self) -> str:
@@ -131,9 +381,10 @@ class HttpRequest():
 
         return (r.text, status_code) if return_status_code else r.text
 
-    def get_json(self, url: str, params: dict=None,
-                 return_status_code=False) -> dict:
-        r, status_code = self.get(url, params=params, return_status_code=True)
+    def get_json(self, url: str, params: dict=None, return_status_code=False,
+                 rate_limit_key: str=None) -> dict:
+        r, status_code = self.get(url, params=params, return_status_code=True,
+                                  rate_limit_key=rate_limit_key)
         if r == None:
             return (None, status_code) if return_status_code else None
 
@@ -158,21 +409,147 @@ class HttpRequest():
 
         return True
 
-    # Retrieve an image from URL and save it to a file
-    def save_image(self, url: str, filename: str) -> bool:
-        r = self.get(url)
+    # Retrieve an image from URL and save it to a file. The image is streamed
+    # to a temporary file which is renamed when complete, so the file is never
+    # left half-written. The digest (e.g. hashlib.sha256()) is updated with
+    # the image content if given.
+    def save_image(self, url: str, filename: str, digest=None) -> bool:
+        r = self.get(url, stream=True)
+        if r == None:
+            logging.error(f'Failure while retrieving an image from {url}.')
+            return False
 
+        temp_filename = filename + '.part'
         try:
-            with open(filename, 'wb') as f:
-                f.write(r.content)
+            with r, open(temp_filename, 'wb') as f:
+                for chunk in r.iter_content(STREAM_CHUNK_SIZE):
+                    f.write(chunk)
+                    if digest != None:
+                        digest.update(chunk)
+            os.replace(temp_filename, filename)
         except OSError:
             logging.exception(f"Can't save the image to the file {filename}.")
-            return False
         except Exception:
             logging.exception(f'Failure while retrieving an image from {url}.')
+        else:
+            return True
+
+        try:
+            os.remove(temp_filename)
+        except OSError:
+            pass
+
+        return False
+
+# A pool member: HTTP client with its own proxy and headers (e.g. access
+# token) and its health state
+class Circuit():
+    def __init__(self, index: int, request: HttpRequest):
+        self.index = index
+        self.request = request
+
+        # These attributes are guarded by the pool
+        self.healthy = True
+        self.active = 0 # Requests in flight
+        self.failures = 0 # Consecutive failures
+        self.last_used = 0
+
+# Spreads requests across several HTTP clients (e.g. going through
+# different TOR instances). Every request is made with a circuit acquired
+# from the pool. Disabled circuits are skipped until they're enabled again
+# (e.g. after getting a new token or a new exit IP).
+class HttpRequestPool():
+    def __init__(self, http_requests: list):
+        self.circuits = [Circuit(index, request)
+                         for index, request in enumerate(http_requests)]
+
+        # Don't change these atrributes from outside the class instance
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def __len__(self) -> int:
+        return len(self.circuits)
+
+    def __iter__(self):
+        return iter(self.circuits)
+
+    def __getitem__(self, index: int) -> Circuit:
+        return self.circuits[index]
+
+    def healthy_count(self) -> int:
+        with self.condition:
+            return sum(circuit.healthy for circuit in self.circuits)
+
+    # Returns the healthy circuit with the least requests in flight (the
+    # least recently used one among equal circuits). Waits for a circuit to
+    # be enabled if all of them are disabled. Returns None on timeout.
+    def acquire(self, timeout: float=None) -> Circuit:
+        with self.condition:
+            if not self.condition.wait_for(
+                    lambda: self.closed or any(circuit.healthy
+                                               for circuit in self.circuits),
+                    timeout=timeout):
+                return None
+
+            if self.closed:
+                return None
+
+            circuit = min((circuit for circuit in self.circuits
+                           if circuit.healthy),
+                          key=lambda circuit: (circuit.active,
+                                               circuit.last_used))
+            circuit.active += 1
+            circuit.last_used = time.monotonic()
+            return circuit
+
+    # Returns True if the circuit has been just disabled because of too
+    # many consecutive failures
+    def release(self, circuit: Circuit, success: bool=True) -> bool:
+        with self.condition:
+            circuit.active -= 1
+
+            if success:
+                circuit.failures = 0
+                return False
+
+            circuit.failures += 1
+            if circuit.healthy and circuit.failures >= CIRCUIT_MAX_FAILURES:
+                logging.warning(f'Circuit {circuit.index} is disabled after '
+                                + f'{circuit.failures} failed requests.')
+                circuit.healthy = False
+                return True
+
             return False
 
-        return True
+    # Returns False if the circuit is already disabled
+    def disable(self, circuit: Circuit) -> bool:
+        with self.condition:
+            if not circuit.healthy:
+                return False
+
+            circuit.healthy = False
+            return True
+
+    def enable(self, circuit: Circuit):
+        with self.condition:
+            circuit.healthy = True
+            circuit.failures = 0
+            self.condition.notify_all()
+
+    # Waits until the pool is closed. Returns False on timeout.
+    def wait_closed(self, timeout: float=None) -> bool:
+        with self.condition:
+            return self.condition.wait_for(lambda: self.closed,
+                                           timeout=timeout)
+
+    # Wakes up all the waiting threads, acquire() returns None afterwards
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        for circuit in self.circuits:
+            circuit.request.close()
 
 # For testing
 def main():
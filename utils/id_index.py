@@ -0,0 +1,113 @@
+import os
+import bisect
+import logging
+from array import array
+
+# Type code for 64-bit unsigned integers (8 bytes per stored id)
+TYPECODE = 'Q'
+
+# Minimal count of recently added ids kept in a hash set before merging them
+# into the sorted array. The actual threshold grows with the index size, so
+# merging costs amortized O(log n) per added id.
+MERGE_THRESHOLD = 4096
+MERGE_RATIO = 8
+
+class IdIndex():
+    def __init__(self, filename: str=None):
+        # The file is an append-only sequence of raw 8-byte ids
+        self.filename = filename
+
+        # Don't change these atrributes from outside the class instance
+        self.ids = array(TYPECODE) # Sorted, no duplicates
+        self.recent = set()
+        self.unsaved = array(TYPECODE)
+
+    def __len__(self) -> int:
+        return len(self.ids) + len(self.recent)
+
+    def __contains__(self, item_id: int) -> bool:
+        if item_id in self.recent:
+            return True
+
+        index = bisect.bisect_left(self.ids, item_id)
+        return index < len(self.ids) and self.ids[index] == item_id
+
+    def _merge(self):
+        # Timsort merges the two sorted runs in linear time
+        ids = list(self.ids)
+        ids.extend(sorted(self.recent))
+        ids.sort()
+        self.ids = array(TYPECODE, ids)
+        self.recent.clear()
+
+    # Returns False if the id is already present in the index
+    def add(self, item_id: int) -> bool:
+        if item_id in self:
+            return False
+
+        self.recent.add(item_id)
+        self.unsaved.append(item_id)
+
+        if len(self.recent) >= max(MERGE_THRESHOLD,
+                                   len(self.ids) // MERGE_RATIO):
+            self._merge()
+
+        return True
+
+    def clear(self):
+        self.ids = array(TYPECODE)
+        self.recent.clear()
+        self.unsaved = array(TYPECODE)
+
+    def load(self) -> bool:
+        self.clear()
+
+        if not self.filename or not os.path.exists(self.filename):
+            return True
+
+        ids = array(TYPECODE)
+
+        try:
+            with open(self.filename, 'rb') as f:
+                data = f.read()
+        except OSError:
+            logging.exception(f"Can't load the file {self.filename}.")
+            return False
+
+        # A truncated trailing record may be left after a crash
+        ids.frombytes(data[:len(data) - len(data) % ids.itemsize])
+        self.ids = array(TYPECODE, sorted(set(ids)))
+
+        return True
+
+    # Appends ids added since the last call to the index file
+    def flush(self) -> bool:
+        if not self.filename or not self.unsaved:
+            return True
+
+        try:
+            with open(self.filename, 'ab') as f:
+                self.unsaved.tofile(f)
+        except OSError:
+            logging.exception(f"Can't write to the file {self.filename}.")
+            return False
+
+        self.unsaved = array(TYPECODE)
+        return True
+
+    # Replaces the index content with the given ids and rewrites the file
+    def rebuild(self, item_ids) -> bool:
+        self.clear()
+        self.ids = array(TYPECODE, sorted(set(item_ids)))
+
+        if not self.filename:
+            return True
+
+        try:
+            with open(self.filename, 'wb') as f:
+                self.ids.tofile(f)
+        except OSError:
+            logging.exception(f"Can't write to the file {self.filename}.")
+            return False
+
+        return True
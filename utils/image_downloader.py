@@ -0,0 +1,237 @@
+import os
+import asyncio
+import sqlite3
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .http_request import HttpRequest, STREAM_CHUNK_SIZE
+
+# Number of images downloaded concurrently
+IMAGE_WORKERS = 8
+
+# The database where the content hashes of the saved images are kept between
+# runs. Every hash is written once, so the saving cost doesn't grow with the
+# images count.
+IMAGE_HASHES_FILENAME = 'images.db'
+
+# Downloads images in a pool of worker threads. Images are streamed to
+# temporary files which are renamed when complete, so existing files are
+# always complete and aren't downloaded again. Identical images (by SHA-256
+# of the content) are stored once: the duplicates become hard links to the
+# first saved file. The hash is known only after the download, so this saves
+# disk space, not traffic.
+#
+# With use_async set, the images are downloaded by the AsyncHttpRequest
+# client on an event loop running in a background thread instead, and the
+# workers count limits the downloads in flight (it may be hundreds).
+class ImageDownloader():
+    def __init__(self, request: HttpRequest, workers: int=IMAGE_WORKERS,
+                 filename: str=IMAGE_HASHES_FILENAME, async_request=None):
+        # These attributes may be changed directly while no downloads are
+        # queued
+        self.request = request
+        self.async_request = async_request
+        self.use_async = False
+        self.workers = workers
+        self.filename = filename
+
+        # Don't change these atrributes from outside the class instance
+        self.connection = None
+        self.executor = None
+        self.loop = None
+        self.loop_thread = None
+        self.semaphore = None
+        self.futures = []
+        self.filenames = set() # Images being downloaded
+        self.lock = threading.RLock()
+
+    def open(self) -> bool:
+        with self.lock:
+            self.close_database()
+
+            try:
+                self.connection = sqlite3.connect(self.filename,
+                                                  check_same_thread=False)
+                self.connection.execute('PRAGMA journal_mode=WAL')
+                self.connection.execute('PRAGMA synchronous=NORMAL')
+                with self.connection:
+                    self.connection.execute(
+                        'CREATE TABLE IF NOT EXISTS hashes '
+                        '(hash TEXT PRIMARY KEY, filename TEXT)')
+            except sqlite3.Error:
+                logging.exception(
+                    f"Can't open the database {self.filename}.")
+                self.close_database()
+                return False
+
+            return True
+
+    def close_database(self):
+        with self.lock:
+            if self.connection != None:
+                self.connection.close()
+                self.connection = None
+
+    # Returns the file name of the image saved before with the same content
+    # hash, saving the new file name if there is no such image
+    def _find_original(self, filename: str, content_hash: str) -> str:
+        with self.lock:
+            if self.connection == None and not self.open():
+                return None
+
+            try:
+                row = self.connection.execute(
+                    'SELECT filename FROM hashes WHERE hash = ?',
+                    (content_hash,)).fetchone()
+                if row and row[0] != filename and os.path.exists(row[0]):
+                    return row[0]
+
+                with self.connection:
+                    self.connection.execute(
+                        'INSERT OR REPLACE INTO hashes (hash, filename) '
+                        'VALUES (?, ?)', (content_hash, filename))
+            except sqlite3.Error:
+                logging.exception(
+                    f"Can't access the database {self.filename}.")
+
+            return None
+
+    # Queues the image download. Returns False if the image is skipped.
+    def submit(self, url: str, filename: str) -> bool:
+        if os.path.exists(filename):
+            logging.debug(f'The image {filename} is already saved. Skipping.')
+            return False
+
+        with self.lock:
+            if filename in self.filenames:
+                return False
+            self.filenames.add(filename)
+
+            if self.use_async:
+                self.futures.append(asyncio.run_coroutine_threadsafe(
+                    self._download_async(url, filename), self._get_loop()))
+                return True
+
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='image')
+            self.futures.append(
+                self.executor.submit(self._download, url, filename))
+
+        return True
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.semaphore = None
+                self.loop_thread = threading.Thread(
+                    target=self.loop.run_forever, daemon=True,
+                    name='image loop')
+                self.loop_thread.start()
+
+            return self.loop
+
+    def _download(self, url: str, filename: str) -> bool:
+        try:
+            digest = hashlib.sha256()
+            if not self.request.save_image(url, filename, digest):
+                return False
+
+            self._deduplicate(filename, digest.hexdigest())
+            return True
+        except Exception:
+            logging.exception(f'Error while saving the image {filename}.')
+            return False
+        finally:
+            with self.lock:
+                self.filenames.discard(filename)
+
+    # Runs on the event loop. Hashing and deduplication are blocking, so
+    # they run in the default executor.
+    async def _download_async(self, url: str, filename: str) -> bool:
+        loop = asyncio.get_running_loop()
+
+        # The semaphore is bound to the loop it's created on
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.workers)
+
+        try:
+            async with self.semaphore:
+                if not await self.async_request.save_image(url, filename):
+                    return False
+
+            content_hash = await loop.run_in_executor(None, self._hash_file,
+                                                      filename)
+            await loop.run_in_executor(None, self._deduplicate, filename,
+                                       content_hash)
+            return True
+        except Exception:
+            logging.exception(f'Error while saving the image {filename}.')
+            return False
+        finally:
+            with self.lock:
+                self.filenames.discard(filename)
+
+    def _hash_file(self, filename: str) -> str:
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b''):
+                digest.update(chunk)
+
+        return digest.hexdigest()
+
+    # Replaces the file with a hard link to the identical image saved before.
+    # The file is kept as is if the link can't be created (e.g. the images
+    # are on different file systems).
+    def _deduplicate(self, filename: str, content_hash: str):
+        original = self._find_original(filename, content_hash)
+        if original is None:
+            return
+
+        link_filename = filename + '.link'
+        try:
+            if os.path.samefile(original, filename):
+                return
+
+            os.link(original, link_filename)
+            os.replace(link_filename, filename)
+        except OSError:
+            logging.debug(f"Can't link the image {filename} "
+                          + f'to the identical image {original}.')
+            if os.path.exists(link_filename):
+                os.remove(link_filename)
+        else:
+            logging.debug(f'The image {filename} is linked '
+                          + f'to the identical image {original}.')
+
+    # Waits for all the queued downloads. Returns the count of failed ones.
+    def wait(self) -> int:
+        with self.lock:
+            futures = self.futures
+            self.futures = []
+
+        return sum(1 for future in futures if not future.result())
+
+    def close(self):
+        self.wait()
+
+        with self.lock:
+            if self.executor != None:
+                self.executor.shutdown()
+                self.executor = None
+
+            loop, self.loop = self.loop, None
+
+        if loop != None:
+            try:
+                asyncio.run_coroutine_threadsafe(self.async_request.close(),
+                                                 loop).result()
+            finally:
+                loop.call_soon_threadsafe(loop.stop)
+                self.loop_thread.join()
+                loop.close()
+
+        self.close_database()
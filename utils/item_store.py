@@ -0,0 +1,577 @@
+import os
+import time
+import json
+import sqlite3
+import logging
+import threading
+from array import array
+
+from .id_index import IdIndex, TYPECODE
+
+STORAGE_JSONL = 'jsonl'
+STORAGE_SQLITE = 'sqlite'
+STORAGE_TYPES = [STORAGE_JSONL, STORAGE_SQLITE]
+
+# Columns indexed in the SQLite store (if present in the item columns)
+SQLITE_INDEXED_COLUMNS = ['user_id', 'category', 'city', 'created_time']
+
+# Rows count fetched at once while iterating over the SQLite store
+SQLITE_FETCH_SIZE = 1000
+
+# Bytes read from the beginning of a JSON file to detect the old format
+LEGACY_PROBE_SIZE = 1024
+
+# Column of the SQLite store with the sequence number of the last change
+SQLITE_SEQ_COLUMN = '_seq'
+
+# Column of the SQLite store with the sequence number of the row insertion.
+# The ids are the row ids, so they can't keep the scraping order.
+SQLITE_ORDER_COLUMN = '_order'
+
+# The order of the rows added before the order column are unknown, they go
+# first in the order of ids
+SQLITE_ORDER = f'ORDER BY "{SQLITE_ORDER_COLUMN}", id'
+
+# Results files of the old versions hold an indented JSON array of the items
+def is_legacy_json(filename: str) -> bool:
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(LEGACY_PROBE_SIZE).lstrip().startswith(b'[')
+    except OSError:
+        return False
+
+# JsonlItemStore and SqliteItemStore have the same interface: len(), iter(),
+# contains(item_id), open(), close(), append(items, phone_tasks), compact(),
+# get_mark() and iter_range(start, end). Items are dicts with the unique 'id'
+# key. Iterating over a store yields all the stored items in the order they
+# were added. Deferred phone tasks are supported by SqliteItemStore only.
+#
+# A mark is a position in the history of store changes. iter_range() yields
+# the items added or changed after the start mark up to the end mark (all
+# the items up to the end mark if the start mark is None).
+
+# Re-iterable view of the store items changed between two marks
+class ItemRange():
+    def __init__(self, store, start: int, end: int):
+        self.store = store
+        self.start = start
+        self.end = end
+
+    def __iter__(self):
+        return self.store.iter_range(self.start, self.end)
+
+# Append-only item log in JSON Lines format: one item per line. The same file
+# is used both for resuming the scraping process and as the final JSON output.
+# The marks are byte offsets in the file, so they are invalidated by
+# compact().
+class JsonlItemStore():
+    def __init__(self, filename: str, index_filename: str=None):
+        self.filename = filename
+        self.index = IdIndex(index_filename)
+
+        # Don't change these atrributes from outside the class instance
+        self.file = None
+        self.count = 0
+
+    def __del__(self):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self):
+        return self.iter_range(None, None)
+
+    def iter_range(self, start: int, end: int):
+        if not os.path.exists(self.filename):
+            return
+
+        with open(self.filename, 'rb') as f:
+            position = start or 0
+            f.seek(position)
+            for line in f:
+                position += len(line)
+                if end != None and position > end:
+                    break
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logging.warning('Skipping corrupted record '
+                                    f'in the file {self.filename}.')
+
+    def get_mark(self) -> int:
+        try:
+            return os.path.getsize(self.filename)
+        except OSError:
+            return 0
+
+    def contains(self, item_id: int) -> bool:
+        return item_id in self.index
+
+    # Results files of the old versions are converted to JSON Lines in place
+    def _convert_legacy(self) -> bool:
+        if not is_legacy_json(self.filename):
+            return True
+
+        logging.info(f'Converting the file {self.filename} '
+                     'to JSON Lines format.')
+
+        try:
+            with open(self.filename, encoding='utf-8') as f:
+                items = json.load(f)
+        except ValueError:
+            logging.exception(f"Can't convert the file {self.filename}.")
+            return False
+
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'wb') as f:
+            for item in items:
+                f.write(json.dumps(item, ensure_ascii=False).encode('utf-8')
+                        + b'\n')
+        os.replace(temp_filename, self.filename)
+
+        return True
+
+    # Streams the log to restore item count and id index. A partially
+    # written trailing record (left after a crash) is cut off.
+    def open(self) -> bool:
+        self.close()
+        self.count = 0
+
+        ids = array(TYPECODE)
+        valid_size = 0
+
+        try:
+            if os.path.exists(self.filename) and not self._convert_legacy():
+                return False
+
+            if os.path.exists(self.filename):
+                with open(self.filename, 'rb') as f:
+                    for line in f:
+                        if not line.endswith(b'\n'):
+                            break
+                        valid_size += len(line)
+                        try:
+                            ids.append(json.loads(line)['id'])
+                        except (ValueError, KeyError, TypeError):
+                            logging.warning('Skipping corrupted record '
+                                            f'in the file {self.filename}.')
+                            continue
+
+                if valid_size != os.path.getsize(self.filename):
+                    logging.warning('Truncating incomplete record '
+                                    f'in the file {self.filename}.')
+                    os.truncate(self.filename, valid_size)
+
+            self.file = open(self.filename, 'ab')
+        except OSError:
+            logging.exception(f"Can't open the file {self.filename}.")
+            return False
+
+        self.count = len(ids)
+
+        if not self.index.load():
+            return False
+
+        # The index file is flushed only after the log, so it can lag
+        # behind it after a crash
+        if len(self.index) != len(ids):
+            logging.info('Rebuilding scraped items index.')
+            return self.index.rebuild(ids)
+
+        return True
+
+    def close(self):
+        file = getattr(self, 'file', None)
+        if file != None:
+            try:
+                file.close()
+            except OSError:
+                logging.exception(f"Can't close the file {self.filename}.")
+
+            self.file = None
+
+    # Items are written with a single fsync per call
+    def append(self, items: list, phone_tasks: list=None) -> bool:
+        if phone_tasks:
+            logging.error('Deferred phone tasks are not supported '
+                          'by JSON Lines store.')
+            return False
+
+        if not items:
+            return True
+
+        if self.file == None and not self.open():
+            return False
+
+        data = b''.join(
+            json.dumps(item, ensure_ascii=False).encode('utf-8') + b'\n'
+            for item in items
+        )
+
+        try:
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        except OSError:
+            logging.exception(f"Can't write to the file {self.filename}.")
+            return False
+
+        for item in items:
+            self.index.add(item['id'])
+        self.count += len(items)
+
+        return self.index.flush()
+
+    # Rewrites the log without duplicated and corrupted records. The file
+    # isn't replaced if no records can be read from it.
+    def compact(self) -> bool:
+        reopen = self.file != None
+        self.close()
+
+        temp_filename = self.filename + '.tmp'
+        seen_ids = IdIndex()
+        ids = array(TYPECODE)
+        records = 0
+
+        try:
+            if os.path.exists(self.filename) and not self._convert_legacy():
+                return False
+
+            with open(temp_filename, 'wb') as f:
+                for item in self:
+                    records += 1
+                    try:
+                        item_id = item['id']
+                    except (KeyError, TypeError):
+                        continue
+
+                    if not seen_ids.add(item_id):
+                        continue
+
+                    ids.append(item_id)
+                    f.write(json.dumps(item, ensure_ascii=False)
+                            .encode('utf-8') + b'\n')
+
+                f.flush()
+                os.fsync(f.fileno())
+
+            if records == 0 and self.get_mark() > 0:
+                logging.error(f'No valid records in the file {self.filename}. '
+                              'It is left as is.')
+                os.remove(temp_filename)
+                return False
+
+            os.replace(temp_filename, self.filename)
+        except OSError:
+            logging.exception(f"Can't compact the file {self.filename}.")
+            return False
+
+        self.count = len(ids)
+        if not self.index.rebuild(ids):
+            return False
+
+        return self.open() if reopen else True
+
+# Embedded SQLite database in WAL mode. Item fields are stored in separate
+# columns, so lookups and exports are plain queries. The store may be shared
+# between threads.
+#
+# The database also keeps the queue of deferred phone requests. Each task
+# is a dict with 'item_id', 'user_id', 'anonymous' and 'created_time' keys.
+#
+# Every added or changed row gets the next sequence number, the marks are
+# these numbers. The number given on insertion keeps the rows order.
+class SqliteItemStore():
+    def __init__(self, filename: str, columns: list):
+        self.filename = filename
+        self.columns = [column for column in columns
+                        if column not in ('id', SQLITE_SEQ_COLUMN,
+                                          SQLITE_ORDER_COLUMN)]
+
+        # Don't change these atrributes from outside the class instance
+        self.connection = None
+        self.lock = threading.RLock()
+        self.seq = 0
+
+    def __del__(self):
+        self.close()
+
+    def _quote(self, name: str) -> str:
+        return '"' + name.replace('"', '""') + '"'
+
+    def _select_columns(self) -> str:
+        return ', '.join(self._quote(column)
+                         for column in ['id'] + self.columns)
+
+    def _execute(self, sql: str, parameters=()) -> list:
+        with self.lock:
+            if self.connection == None and not self.open():
+                return None
+
+            try:
+                return self.connection.execute(sql, parameters).fetchall()
+            except sqlite3.Error:
+                logging.exception(
+                    f"Can't query the database {self.filename}.")
+                return None
+
+    def _execute_transaction(self, statements: list) -> bool:
+        with self.lock:
+            if self.connection == None and not self.open():
+                return False
+
+            try:
+                with self.connection:
+                    for sql, parameters in statements:
+                        self.connection.executemany(sql, parameters)
+            except sqlite3.Error:
+                logging.exception(
+                    f"Can't write to the database {self.filename}.")
+                return False
+
+            return True
+
+    def __len__(self) -> int:
+        rows = self._execute('SELECT COUNT(*) FROM items')
+        return rows[0][0] if rows else 0
+
+    def __iter__(self):
+        return self._iter_query(SQLITE_ORDER)
+
+    def iter_range(self, start: int, end: int):
+        seq = self._quote(SQLITE_SEQ_COLUMN)
+        if start is None:
+            return self._iter_query(
+                f'WHERE {seq} IS NULL OR {seq} <= ? {SQLITE_ORDER}',
+                (self.seq if end is None else end,))
+        else:
+            return self._iter_query(
+                f'WHERE {seq} > ? AND {seq} <= ? ORDER BY {seq}',
+                (start, self.seq if end is None else end))
+
+    def get_mark(self) -> int:
+        with self.lock:
+            if self.connection == None and not self.open():
+                return None
+
+            return self.seq
+
+    def _iter_query(self, condition: str, parameters=()):
+        with self.lock:
+            if self.connection == None and not self.open():
+                return
+
+            cursor = self.connection.cursor()
+            cursor.execute(f'SELECT {self._select_columns()} FROM items '
+                           + condition, parameters)
+
+        columns = ['id'] + self.columns
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(SQLITE_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(zip(columns, row))
+
+    def contains(self, item_id: int) -> bool:
+        return bool(self._execute('SELECT 1 FROM items WHERE id = ?',
+                                  (item_id,)))
+
+    def open(self) -> bool:
+        with self.lock:
+            self.close()
+
+            columns = ', '.join(
+                ['id INTEGER PRIMARY KEY']
+                + [self._quote(column) for column in self.columns])
+
+            try:
+                self.connection = sqlite3.connect(self.filename,
+                                                  check_same_thread=False)
+                self.connection.execute('PRAGMA journal_mode=WAL')
+                self.connection.execute('PRAGMA synchronous=NORMAL')
+                with self.connection:
+                    self.connection.execute(
+                        f'CREATE TABLE IF NOT EXISTS items ({columns})')
+                    # Databases created by the previous versions don't have
+                    # the sequence columns
+                    table_columns = [
+                        row[1] for row in self.connection.execute(
+                            'PRAGMA table_info(items)')
+                    ]
+                    seq_columns = [SQLITE_SEQ_COLUMN, SQLITE_ORDER_COLUMN]
+                    for column in seq_columns:
+                        if column not in table_columns:
+                            self.connection.execute(
+                                'ALTER TABLE items ADD COLUMN '
+                                + f'{self._quote(column)} INTEGER')
+
+                    for column in SQLITE_INDEXED_COLUMNS + seq_columns:
+                        if column in self.columns + seq_columns:
+                            self.connection.execute(
+                                'CREATE INDEX IF NOT EXISTS '
+                                + self._quote(f'items_{column}')
+                                + f' ON items ({self._quote(column)})')
+                    self.connection.execute(
+                        'CREATE TABLE IF NOT EXISTS phone_queue ('
+                        'item_id INTEGER PRIMARY KEY, user_id, '
+                        'anonymous INTEGER, created_time, '
+                        'attempts INTEGER DEFAULT 0, '
+                        'next_attempt_time REAL DEFAULT 0)')
+                    queue_columns = [
+                        row[1] for row in self.connection.execute(
+                            'PRAGMA table_info(phone_queue)')
+                    ]
+                    if 'next_attempt_time' not in queue_columns:
+                        self.connection.execute(
+                            'ALTER TABLE phone_queue ADD COLUMN '
+                            'next_attempt_time REAL DEFAULT 0')
+
+                self.seq = self.connection.execute(
+                    'SELECT MAX(' + self._quote(SQLITE_SEQ_COLUMN)
+                    + ') FROM items').fetchone()[0] or 0
+            except sqlite3.Error:
+                logging.exception(
+                    f"Can't open the database {self.filename}.")
+                self.close()
+                return False
+
+            return True
+
+    def close(self):
+        with self.lock:
+            connection = getattr(self, 'connection', None)
+            if connection != None:
+                try:
+                    connection.close()
+                except sqlite3.Error:
+                    logging.exception(
+                        f"Can't close the database {self.filename}.")
+
+                self.connection = None
+
+    # All the items (and phone tasks for them) are written in a single
+    # transaction
+    def append(self, items: list, phone_tasks: list=None) -> bool:
+        if not items:
+            return True
+
+        columns = ['id'] + self.columns
+        placeholders = ', '.join('?' * (len(columns) + 2))
+
+        with self.lock:
+            statements = [(
+                f'INSERT OR REPLACE INTO items ({self._select_columns()}, '
+                f'{self._quote(SQLITE_SEQ_COLUMN)}, '
+                f'{self._quote(SQLITE_ORDER_COLUMN)}) '
+                f'VALUES ({placeholders})',
+                [[item.get(column, '') for column in columns]
+                 + [self.seq + index + 1] * 2
+                 for index, item in enumerate(items)]
+            )]
+
+            if phone_tasks:
+                statements.append((
+                    'INSERT OR REPLACE INTO phone_queue '
+                    '(item_id, user_id, anonymous, created_time) '
+                    'VALUES (?, ?, ?, ?)',
+                    [[task['item_id'], task['user_id'],
+                      int(task['anonymous']), task['created_time']]
+                     for task in phone_tasks]
+                ))
+
+            if not self._execute_transaction(statements):
+                return False
+
+            self.seq += len(items)
+            return True
+
+    def compact(self) -> bool:
+        with self.lock:
+            if self.connection == None and not self.open():
+                return False
+
+            try:
+                self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                self.connection.execute('VACUUM')
+            except sqlite3.Error:
+                logging.exception(
+                    f"Can't compact the database {self.filename}.")
+                return False
+
+            return True
+
+    def count_phone_tasks(self) -> int:
+        rows = self._execute('SELECT COUNT(*) FROM phone_queue')
+        return rows[0][0] if rows else 0
+
+    def _phone_task_conditions(self, exclude_ids: list,
+                               anonymous_only: bool) -> list:
+        conditions = []
+        if exclude_ids:
+            conditions.append('item_id NOT IN ('
+                              + ', '.join('?' * len(exclude_ids)) + ')')
+        if anonymous_only:
+            conditions.append('anonymous = 1')
+        return conditions
+
+    # Returns the task with the highest priority among the tasks due by now:
+    # less attempts first, then non-protected phones, then the newest items
+    def get_phone_task(self, exclude_ids: list=(),
+                       anonymous_only: bool=False) -> dict:
+        conditions = self._phone_task_conditions(exclude_ids, anonymous_only)
+        conditions.append('next_attempt_time <= ?')
+
+        rows = self._execute(
+            'SELECT item_id, user_id, anonymous, created_time, attempts '
+            'FROM phone_queue WHERE ' + ' AND '.join(conditions)
+            + ' ORDER BY attempts, anonymous DESC, created_time DESC LIMIT 1',
+            list(exclude_ids) + [time.time()])
+        if not rows:
+            return None
+
+        item_id, user_id, anonymous, created_time, attempts = rows[0]
+        return {
+            'item_id': item_id,
+            'user_id': user_id,
+            'anonymous': bool(anonymous),
+            'created_time': created_time,
+            'attempts': attempts,
+        }
+
+    # Stores the phones retrieved for the task and removes it from the queue
+    def resolve_phone_task(self, item_id: int, contact_phones: str) -> bool:
+        with self.lock:
+            if not self._execute_transaction([
+                    ('UPDATE items SET contact_phones = ?, '
+                     + f'{self._quote(SQLITE_SEQ_COLUMN)} = ? WHERE id = ?',
+                     [(contact_phones, self.seq + 1, item_id)]),
+                    ('DELETE FROM phone_queue WHERE item_id = ?',
+                     [(item_id,)]),
+            ]):
+                return False
+
+            self.seq += 1
+            return True
+
+    # Returns the time the next of the tasks is due (UNIX time) or None if
+    # there are no such tasks
+    def get_next_phone_task_time(self, exclude_ids: list=(),
+                                 anonymous_only: bool=False) -> float:
+        conditions = self._phone_task_conditions(exclude_ids, anonymous_only)
+        where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+
+        rows = self._execute(
+            f'SELECT MIN(next_attempt_time) FROM phone_queue {where}',
+            list(exclude_ids))
+        return rows[0][0] if rows else None
+
+    # The task is not claimed again until the delay (seconds) passes
+    def postpone_phone_task(self, item_id: int, delay: float=0) -> bool:
+        return self._execute_transaction([
+            ('UPDATE phone_queue SET attempts = attempts + 1, '
+             'next_attempt_time = ? WHERE item_id = ?',
+             [(time.time() + delay, item_id)]),
+        ])
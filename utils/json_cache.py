@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import logging
+import threading
+
+# Key-value cache persisted to a JSON file. Every entry may have its own
+# expiration time. Keys are always converted to strings.
+class JsonCache():
+    def __init__(self, filename: str):
+        self.filename = filename
+
+        # Don't change these atrributes from outside the class instance
+        self.entries = {}
+        self.modified = False # Changed since loading or saving
+        self.lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def load(self) -> bool:
+        with self.lock:
+            self.entries = {}
+            self.modified = False
+
+            if not os.path.exists(self.filename):
+                return True
+
+            try:
+                with open(self.filename, encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except OSError:
+                logging.warning(f"Can't load the file {self.filename}.")
+                return False
+            except ValueError:
+                logging.warning(f'The file {self.filename} is corrupted.')
+                return False
+
+            return True
+
+    # The file is replaced atomically, so it's never left half-written
+    def save(self) -> bool:
+        with self.lock:
+            temp_filename = self.filename + '.tmp'
+            try:
+                with open(temp_filename, 'w', encoding='utf-8') as f:
+                    json.dump(self.entries, f, ensure_ascii=False)
+                os.replace(temp_filename, self.filename)
+            except OSError:
+                logging.exception(f"Can't write to the file {self.filename}.")
+                return False
+
+            self.modified = False
+            return True
+
+    # Returns the default value if the entry is missing or expires within
+    # the margin (seconds)
+    def get(self, key, default=None, margin: float=0):
+        with self.lock:
+            entry = self.entries.get(str(key))
+            if entry == None:
+                return default
+
+            expires = entry.get('expires')
+            if expires != None and expires - margin <= time.time():
+                return default
+
+            return entry['value']
+
+    # Returns expiration time of the entry (None if it never expires)
+    def get_expires(self, key) -> float:
+        with self.lock:
+            entry = self.entries.get(str(key))
+            if entry == None:
+                return None
+
+            return entry.get('expires')
+
+    # Either ttl (seconds from now) or expires (UNIX time) may be given;
+    # the entry never expires if both are omitted
+    def set(self, key, value, ttl: float=None, expires: float=None):
+        if ttl != None:
+            expires = time.time() + ttl
+
+        with self.lock:
+            self.entries[str(key)] = {'value': value, 'expires': expires}
+            self.modified = True
+
+    # Returns (key, value) pairs of all the entries which are not expired
+    def items(self) -> list:
+        now = time.time()
+        with self.lock:
+            return [(key, entry['value'])
+                    for key, entry in self.entries.items()
+                    if entry.get('expires') is None or entry['expires'] > now]
+
+    def invalidate(self, key):
+        with self.lock:
+            if self.entries.pop(str(key), None) != None:
+                self.modified = True
+
+    # Drops all the expired entries
+    def purge(self):
+        now = time.time()
+        with self.lock:
+            for key in list(self.entries.keys()):
+                expires = self.entries[key].get('expires')
+                if expires != None and expires <= now:
+                    del self.entries[key]
+                    self.modified = True
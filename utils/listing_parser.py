@@ -0,0 +1,175 @@
+import sys
+import time
+import logging
+
+from bs4 import BeautifulSoup
+
+try:
+    from lxml import etree
+    from lxml import html as lxml_html
+except ImportError:
+    lxml_html = None
+
+# Listing pages are parsed with XPath queries on the raw lxml tree, which
+# is several times faster than building a BeautifulSoup tree. BeautifulSoup
+# is used if lxml is not available or fails to parse the page.
+
+CLASS_XPATH = "contains(concat(' ', normalize-space(@class), ' '), ' {} ')"
+
+OFFERS_TABLE_XPATH = "(//table[@id='offers_table'])[1]"
+OFFER_WRAPPERS_XPATH = ('.//div[' + CLASS_XPATH.format('offer-wrapper') + ']')
+OFFER_ID_XPATH = '(.//table)[1]/@data-id'
+PAGE_LINK_LAST_XPATH = "(//a[@data-cy='page-link-last'])[1]"
+PAGE_LINK_TEXT_XPATH = 'string((.//span)[1])'
+RANDOM_ITEM_URL_XPATH = ('((//h4[' + CLASS_XPATH.format('normal') + '])[1]'
+                         + '//a)[1]/@href')
+
+# Repeats of parsing every page in the benchmark
+BENCHMARK_REPEATS = 20
+
+class ParsingError(Exception):
+    pass
+
+def _parse_tree(html: str):
+    if not html or not html.strip():
+        raise ParsingError('Empty page.')
+
+    try:
+        return lxml_html.fromstring(html)
+    except (etree.LxmlError, ValueError) as e:
+        raise ParsingError(str(e))
+
+def _lxml_page_count(tree) -> int:
+    page_link_last = tree.xpath(PAGE_LINK_LAST_XPATH)
+    if not page_link_last:
+        return 1
+
+    try:
+        return int(page_link_last[0].xpath(PAGE_LINK_TEXT_XPATH))
+    except ValueError:
+        raise ParsingError("Can't parse page count.")
+
+def _lxml_item_ids(tree) -> list:
+    offers_table = tree.xpath(OFFERS_TABLE_XPATH)
+    if not offers_table:
+        raise ParsingError("Can't find offers table.")
+
+    item_ids = []
+    for offer_wrapper in offers_table[0].xpath(OFFER_WRAPPERS_XPATH):
+        item_id = offer_wrapper.xpath(OFFER_ID_XPATH)
+        if not item_id:
+            raise ParsingError("Can't find item id.")
+        try:
+            item_ids.append(int(item_id[0]))
+        except ValueError:
+            raise ParsingError("Can't parse item id.")
+
+    return item_ids
+
+def _lxml_random_item_url(tree) -> str:
+    item_url = tree.xpath(RANDOM_ITEM_URL_XPATH)
+    if not item_url:
+        raise ParsingError("Can't find item URL.")
+
+    return str(item_url[0])
+
+def _soup_page_count(soup: BeautifulSoup) -> int:
+    page_link_last = soup.find('a', attrs={'data-cy': 'page-link-last'})
+    if not page_link_last:
+        return 1
+
+    try:
+        return int(page_link_last.span.get_text())
+    except (AttributeError, ValueError):
+        raise ParsingError("Can't parse page count.")
+
+def _soup_item_ids(soup: BeautifulSoup) -> list:
+    try:
+        div_tags = (
+            soup
+            .find('table', id='offers_table')
+            .find_all('div', class_='offer-wrapper')
+        )
+
+        return [int(div_tag.table['data-id']) for div_tag in div_tags]
+    except (AttributeError, KeyError, TypeError, ValueError):
+        raise ParsingError("Can't parse item ids.")
+
+def _soup_random_item_url(soup: BeautifulSoup) -> str:
+    try:
+        return soup.find('h4', class_='normal').a['href']
+    except (AttributeError, KeyError, TypeError):
+        raise ParsingError("Can't parse item URL.")
+
+# Applies the extractors to the page parsed with lxml, falling back to
+# BeautifulSoup. Returns the list of extracted values or None on failure.
+def _parse(html: str, lxml_extractors: list, soup_extractors: list,
+           use_lxml: bool=True) -> list:
+    if use_lxml and lxml_html != None:
+        try:
+            tree = _parse_tree(html)
+            return [extractor(tree) for extractor in lxml_extractors]
+        except ParsingError:
+            logging.warning('Fast page parsing failed. '
+                            'Falling back to BeautifulSoup.')
+
+    try:
+        soup = BeautifulSoup(html or '', 'lxml' if lxml_html else
+                             'html.parser')
+        return [extractor(soup) for extractor in soup_extractors]
+    except ParsingError:
+        logging.exception('Error while parsing the page.')
+        return None
+
+# Returns (page_count, item_ids) pair or None on failure
+def parse_listing(html: str, use_lxml: bool=True) -> tuple:
+    result = _parse(html, [_lxml_page_count, _lxml_item_ids],
+                    [_soup_page_count, _soup_item_ids], use_lxml)
+    return tuple(result) if result != None else None
+
+def parse_item_ids(html: str, use_lxml: bool=True) -> list:
+    result = _parse(html, [_lxml_item_ids], [_soup_item_ids], use_lxml)
+    return result[0] if result != None else None
+
+def parse_page_count(html: str, use_lxml: bool=True) -> int:
+    result = _parse(html, [_lxml_page_count], [_soup_page_count], use_lxml)
+    return result[0] if result != None else None
+
+def parse_random_item_url(html: str, use_lxml: bool=True) -> str:
+    result = _parse(html, [_lxml_random_item_url], [_soup_random_item_url],
+                    use_lxml)
+    return result[0] if result != None else None
+
+# Benchmark over saved listing pages:
+#     python -m utils.listing_parser page1.html page2.html ...
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    pages = []
+    for filename in sys.argv[1:]:
+        with open(filename, encoding='utf-8') as f:
+            pages.append(f.read())
+
+    if not pages:
+        print('Usage: python -m utils.listing_parser <saved pages>')
+        return
+
+    timings = {}
+    for use_lxml in [True, False]:
+        start_time = time.perf_counter()
+        for i in range(BENCHMARK_REPEATS):
+            results = [parse_listing(html, use_lxml) for html in pages]
+        timings[use_lxml] = ((time.perf_counter() - start_time)
+                             / BENCHMARK_REPEATS / len(pages))
+
+        if use_lxml:
+            lxml_results = results
+        elif results != lxml_results:
+            print('WARNING: the parsing results differ.')
+
+    print(f'lxml XPath: {timings[True] * 1000:.2f} ms per page')
+    print(f'BeautifulSoup: {timings[False] * 1000:.2f} ms per page')
+    print(f'Speedup: {timings[False] / timings[True]:.1f}x')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import time
+import logging
+import threading
+
+from .json_cache import JsonCache
+
+# Quota period length (seconds)
+QUOTA_PERIOD = 24 * 60 * 60
+
+# Persisted per-account counters of the limited API requests. The counter of
+# an account is reset when its period (started by the first request) ends.
+class QuotaLedger():
+    def __init__(self, filename: str, limit: int,
+                 period: float=QUOTA_PERIOD):
+        self.limit = limit
+        self.period = period
+
+        # Don't change these atrributes from outside the class instance
+        self.cache = JsonCache(filename)
+        self.lock = threading.RLock()
+
+    def load(self) -> bool:
+        with self.lock:
+            if not self.cache.load():
+                return False
+
+            self.cache.purge()
+            return True
+
+    def save(self) -> bool:
+        if not self.cache.save():
+            logging.warning("Can't save the quota ledger.")
+            return False
+
+        return True
+
+    def used(self, account: str) -> int:
+        return self.cache.get(account, 0)
+
+    def remaining(self, account: str) -> int:
+        return max(self.limit - self.used(account), 0)
+
+    def has_budget(self, account: str) -> bool:
+        return self.remaining(account) > 0
+
+    # Registers one successful limited request
+    def consume(self, account: str) -> bool:
+        with self.lock:
+            used = self.used(account)
+            if used == 0:
+                expires = time.time() + self.period
+            else:
+                expires = self.cache.get_expires(account)
+
+            self.cache.set(account, used + 1, expires=expires)
+            return self.save()
+
+    # Marks the account as having no budget until its period ends (e.g. when
+    # the API refuses a request before the counter reaches the limit)
+    def exhaust(self, account: str) -> bool:
+        with self.lock:
+            if self.used(account) == 0:
+                expires = time.time() + self.period
+            else:
+                expires = self.cache.get_expires(account)
+
+            self.cache.set(account, self.limit, expires=expires)
+            return self.save()
+
+    # Returns the earliest time when one of the accounts gets budget again
+    def next_reset_time(self, accounts: list) -> float:
+        times = [self.cache.get_expires(account) for account in accounts
+                 if not self.has_budget(account)]
+        times = [reset_time for reset_time in times if reset_time != None]
+        return min(times) if times else None
+
+    def all_exhausted(self, accounts: list) -> bool:
+        return not any(self.has_budget(account) for account in accounts)
@@ -0,0 +1,162 @@
+import time
+import logging
+import threading
+
+# Response codes which mean the server wants the client to slow down (by
+# default, a limiter may have its own list)
+THROTTLE_STATUS_CODES = [403, 429]
+
+# Request rate limits (requests per second)
+RATE_INITIAL = 5
+RATE_MIN = 0.2
+RATE_MAX = 50
+
+# Concurrent requests limits
+CONCURRENCY_INITIAL = 4
+CONCURRENCY_MIN = 1
+CONCURRENCY_MAX = 32
+
+# Additive increase: the rate grows by this value (requests per second)
+# after about a second of successful requests, the concurrency limit grows
+# by 1 after a "window" of successful requests
+RATE_INCREASE = 0.5
+
+# Multiplicative decrease of the rate and the concurrency on throttling
+DECREASE_FACTOR = 0.5
+
+# Responses slower than the average latency multiplied by this factor mean
+# the server is congested: the limits are not increased
+LATENCY_FACTOR = 2
+
+# Smoothing factor of the average latency
+LATENCY_ALPHA = 0.1
+
+# All the requests to the host are paused after throttling. The pause is
+# doubled with every consecutive throttling (seconds).
+BACKOFF_BASE = 1
+BACKOFF_MAX = 100
+
+# Token bucket limiting the request rate combined with an AIMD controller
+# (additive increase, multiplicative decrease) which adapts the rate and
+# the concurrency limit to the server responses
+class RateLimiter():
+    def __init__(self, name: str, rate: float=RATE_INITIAL,
+                 concurrency: int=CONCURRENCY_INITIAL,
+                 throttle_status_codes: list=THROTTLE_STATUS_CODES):
+        self.name = name
+        self.throttle_status_codes = throttle_status_codes
+
+        # Don't change these atrributes from outside the class instance
+        self.rate = rate
+        self.concurrency = float(concurrency)
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.active = 0
+        self.latency = None
+        self.throttles = 0 # Consecutive throttled responses
+        self.decreased = 0 # Time of the last decrease
+        self.blocked_until = 0
+        self.condition = threading.Condition()
+
+    # The bucket holds up to one second worth of requests
+    def _refill(self, now: float):
+        self.tokens = min(max(1.0, self.rate),
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Waits for a free slot and returns the request start time, which is
+    # passed to release() afterwards
+    def acquire(self) -> float:
+        with self.condition:
+            while True:
+                start_time, wait_time = self._try_acquire()
+                if start_time != None:
+                    return start_time
+
+                self.condition.wait(wait_time)
+
+    # Takes a free slot without waiting (e.g. for asyncio clients which
+    # can't block). Returns (start_time, None) on success or (None,
+    # wait_time), the wait time is None until any request is released.
+    def try_acquire(self) -> tuple:
+        with self.condition:
+            return self._try_acquire()
+
+    def _try_acquire(self) -> tuple:
+        now = time.monotonic()
+        self._refill(now)
+
+        if now < self.blocked_until:
+            return None, self.blocked_until - now
+        elif self.active >= int(self.concurrency):
+            return None, None
+        elif self.tokens < 1:
+            return None, (1 - self.tokens) / self.rate
+
+        self.tokens -= 1
+        self.active += 1
+        return now, None
+
+    # The status code is None if the request failed without a response
+    def release(self, start_time: float, status_code: int=None):
+        now = time.monotonic()
+
+        with self.condition:
+            self.active -= 1
+
+            if status_code in self.throttle_status_codes:
+                self._decrease(start_time, now)
+            elif status_code != None:
+                self.throttles = 0
+                if not self._congested(now - start_time):
+                    self._increase()
+
+            self.condition.notify_all()
+
+    def _decrease(self, start_time: float, now: float):
+        # The requests sent before the previous decrease don't reflect it
+        if start_time < self.decreased:
+            return
+
+        self.throttles += 1
+        self.decreased = now
+        self.rate = max(RATE_MIN, self.rate * DECREASE_FACTOR)
+        self.concurrency = max(CONCURRENCY_MIN,
+                               self.concurrency * DECREASE_FACTOR)
+
+        backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (self.throttles - 1))
+        self.blocked_until = max(self.blocked_until, now + backoff)
+
+        logging.info(f'Requests to {self.name} are throttled. Pausing for '
+                     + f'{backoff} seconds. Rate limit: {self.rate:.2f} '
+                     + f'requests per second, concurrency limit: '
+                     + f'{int(self.concurrency)}.')
+
+    def _increase(self):
+        self.rate = min(RATE_MAX, self.rate + RATE_INCREASE / self.rate)
+        self.concurrency = min(CONCURRENCY_MAX,
+                               self.concurrency + 1 / self.concurrency)
+
+    def _congested(self, latency: float) -> bool:
+        if self.latency is None:
+            self.latency = latency
+            return False
+
+        congested = latency > self.latency * LATENCY_FACTOR
+        self.latency += LATENCY_ALPHA * (latency - self.latency)
+        return congested
+
+# The limiters are shared by all the HTTP clients in the process, so the
+# limits apply to the whole traffic to a host. Requests to an endpoint with
+# its own limits may use a separate key instead of the host name.
+limiters = {} # key: host name or endpoint key; value: RateLimiter
+limiters_lock = threading.Lock()
+
+def get_rate_limiter(key: str) -> RateLimiter:
+    with limiters_lock:
+        limiter = limiters.get(key)
+        if limiter is None:
+            limiter = RateLimiter(key)
+            limiters[key] = limiter
+
+        return limiter
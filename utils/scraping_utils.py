@@ -1,16 +1,26 @@
 import csv
 import json
 import re
+import time
+import base64
 import os
 import os.path
 import logging
 import logging.handlers
 import unicodedata
+from datetime import datetime
 
 import xlsxwriter
 from bs4 import BeautifulSoup
 from bs4.element import NavigableString, Tag
 
+# Parquet export is optional: it requires pyarrow package
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 # Directory name for saving log files
 LOG_FOLDER = 'logs'
 
@@ -38,6 +48,24 @@ CSV_DELIMITER = ','
 
 LAST_PROCESSED_PAGE_FILENAME = 'last_processed_page.txt'
 
+# Buffer size of the files written by the exporters (bytes)
+EXPORT_BUFFER_SIZE = 1024 * 1024
+
+# Exporters report their progress after every this count of rows
+EXPORT_PROGRESS_ROWS = 100000
+
+# Maximum rows count of an Excel worksheet (including the header row)
+XLSX_MAX_ROWS = 1048576
+
+# Column types for XLSX export
+XLSX_TYPE_STRING = 'string'
+XLSX_TYPE_NUMBER = 'number'
+
+# Rows count of a Parquet row group (items are buffered in memory until a
+# row group is written)
+PARQUET_BATCH_ROWS = 50000
+PARQUET_COMPRESSION = 'zstd'
+
 # Setting up configuration for logging
 def setup_logging():
     logFormatter = logging.Formatter(
@@ -105,6 +133,16 @@ def get_plain_text(root_tag: Tag) -> str:
 def clean_phone(phone: str) -> str:
     return re.sub(r'\s+|-|\(|\)', '', phone)
 
+# Returns expiration time (UNIX time) from 'exp' claim of a JSON Web Token.
+# The signature is not verified.
+def get_jwt_expiry(token: str) -> float:
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except Exception:
+        return None
+
 def swap_scheme(url: str) -> str:
     if url.startswith('http://'):
         return re.sub(r'^http://', 'https://', url)
@@ -154,38 +192,194 @@ def save_item_csv(item: dict, columns: list, filename: str,
 
     return True
 
-# Saves prepared items list to a CSV file
-def save_items_csv(items: list, columns: list, filename: str) -> bool:
-    for index, item in enumerate(items):
-        if not save_item_csv(item, columns, filename,
-                             first_item = (index == 0)):
-            return False
+def log_export_progress(filename: str, rows: int, start_time: float,
+                        complete: bool=False):
+    elapsed = time.monotonic() - start_time
+    rate = rows / elapsed if elapsed > 0 else 0
+    logging.info(f'{"Saved" if complete else "Saving"} {filename}: '
+                 + f'{rows} rows in {elapsed:.1f} s ({rate:.0f} rows/s).')
+
+# Streams items from any iterable (a list or an item store) to a CSV file
+# through a single buffered file handle
+def save_items_csv(items, columns: list, filename: str) -> bool:
+    start_time = time.monotonic()
+    rows = 0
+
+    try:
+        with open(filename, 'w', newline='', encoding='utf-8',
+                  buffering=EXPORT_BUFFER_SIZE) as f:
+            writer = csv.writer(f, delimiter=CSV_DELIMITER, lineterminator=LT)
+            writer.writerow(columns)
+            for item in items:
+                writer.writerow([item.get(key, '') for key in columns])
+                rows += 1
+                if rows % EXPORT_PROGRESS_ROWS == 0:
+                    log_export_progress(filename, rows, start_time)
+    except OSError:
+        logging.exception(f"Can't write to CSV file {filename}.")
+        return False
+    except Exception:
+        logging.exception('Scraped data saving fault.')
+        return False
 
+    log_export_progress(filename, rows, start_time, complete=True)
     return True
 
-def save_items_xlsx(items: list, columns: list, filename: str) -> bool:
+# Streams items from any iterable to an XLSX file in constant memory mode:
+# every row is flushed to a temporary file as soon as the next one starts.
+# A new worksheet is added when the current one is full. Column widths and
+# types are optional dicts keyed by column name; string type is default.
+def save_items_xlsx(items, columns: list, filename: str,
+                    column_widths: dict=None, column_types: dict=None) -> bool:
+    column_widths = column_widths or {}
+    column_types = column_types or {}
+    number_columns = [column_types.get(key) == XLSX_TYPE_NUMBER
+                      for key in columns]
+
+    start_time = time.monotonic()
+    rows = 0
+
     try:
-        workbook = xlsxwriter.Workbook(filename)
+        workbook = xlsxwriter.Workbook(filename, {'constant_memory': True})
     except Exception:
         logging.exception(f"Can't create {filename} workbook.")
         return False
 
     bold = workbook.add_format({'bold': True})
-    worksheet = workbook.add_worksheet()
-
-    for column, title in enumerate(columns):
-        worksheet.write(0, column, title, bold)
 
-    for item_index, item in enumerate(items):
+    def add_worksheet():
+        worksheet = workbook.add_worksheet()
         for column, key in enumerate(columns):
-            worksheet.write(item_index + 1, column, str(item.get(key, '')))
+            if key in column_widths:
+                worksheet.set_column(column, column, column_widths[key])
+            worksheet.write_string(0, column, key, bold)
+        return worksheet
 
     try:
+        worksheet = add_worksheet()
+        row = 0
+
+        for item in items:
+            row += 1
+            if row == XLSX_MAX_ROWS:
+                worksheet = add_worksheet()
+                row = 1
+
+            for column, key in enumerate(columns):
+                value = item.get(key, '')
+                if value == '' or value is None:
+                    continue
+
+                if (number_columns[column] and
+                        isinstance(value, (int, float)) and
+                        not isinstance(value, bool)):
+                    worksheet.write_number(row, column, value)
+                elif isinstance(value, str):
+                    worksheet.write_string(row, column, value)
+                else:
+                    worksheet.write_string(row, column, str(value))
+
+            rows += 1
+            if rows % EXPORT_PROGRESS_ROWS == 0:
+                log_export_progress(filename, rows, start_time)
+
         workbook.close()
     except Exception:
         logging.exception(f"Can't save {filename} workbook.")
         return False
 
+    log_export_progress(filename, rows, start_time, complete=True)
+    return True
+
+def parquet_available() -> bool:
+    return pyarrow != None
+
+def _to_int(value) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+# Date and time strings are expected in 'YYYY-MM-DD HH:MM:SS' format
+def _to_datetime(value) -> datetime:
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+# Streams items from any iterable to a Parquet file, one row group per
+# PARQUET_BATCH_ROWS items. Low-cardinality string columns are dictionary
+# encoded, timestamp columns are stored as timestamps, integer columns as
+# 64-bit integers, the rest as strings. Empty values are stored as nulls.
+def save_items_parquet(items, columns: list, filename: str,
+                       dictionary_columns: list=(),
+                       timestamp_columns: list=(),
+                       integer_columns: list=()) -> bool:
+    if pyarrow is None:
+        logging.error('Parquet export requires pyarrow package.')
+        return False
+
+    fields = []
+    converters = []
+    for key in columns:
+        if key in integer_columns:
+            fields.append(pyarrow.field(key, pyarrow.int64()))
+            converters.append(_to_int)
+        elif key in timestamp_columns:
+            fields.append(pyarrow.field(key, pyarrow.timestamp('s')))
+            converters.append(_to_datetime)
+        elif key in dictionary_columns:
+            fields.append(pyarrow.field(
+                key, pyarrow.dictionary(pyarrow.int32(), pyarrow.string())))
+            converters.append(None)
+        else:
+            fields.append(pyarrow.field(key, pyarrow.string()))
+            converters.append(None)
+    schema = pyarrow.schema(fields)
+
+    def write_batch(writer, batch: list):
+        arrays = []
+        for index, key in enumerate(columns):
+            values = [item.get(key) for item in batch]
+            values = [None if value == '' else value for value in values]
+            if converters[index] != None:
+                values = [converters[index](value) if value != None
+                          else None for value in values]
+            else:
+                values = [str(value) if value != None else None
+                          for value in values]
+
+            if key in dictionary_columns:
+                array = pyarrow.array(values, pyarrow.string())
+                arrays.append(array.dictionary_encode())
+            else:
+                arrays.append(pyarrow.array(values, schema.field(key).type))
+
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+
+    start_time = time.monotonic()
+    rows = 0
+
+    try:
+        with pyarrow.parquet.ParquetWriter(
+                filename, schema, compression=PARQUET_COMPRESSION) as writer:
+            batch = []
+            for item in items:
+                batch.append(item)
+                if len(batch) == PARQUET_BATCH_ROWS:
+                    write_batch(writer, batch)
+                    rows += len(batch)
+                    batch = []
+                    log_export_progress(filename, rows, start_time)
+
+            if batch or not rows:
+                write_batch(writer, batch)
+                rows += len(batch)
+    except Exception:
+        logging.exception(f"Can't write to Parquet file {filename}.")
+        return False
+
+    log_export_progress(filename, rows, start_time, complete=True)
     return True
 
 def load_items_csv(filename: str, columns: list) -> list:
@@ -210,11 +404,26 @@ def load_items_csv(filename: str, columns: list) -> list:
 
     return items
 
-# Saves item list to a JSON file
+# Saves item list to a JSON file. The data is written to a temporary file
+# which replaces the old one, so the file is never left half-written.
 def save_items_json(items: list, filename: str) -> bool:
+    temp_filename = filename + '.tmp'
     try:
-        with open(filename, 'w', encoding='utf-8') as f:
+        with open(temp_filename, 'w', encoding='utf-8') as f:
             json.dump(items, f, ensure_ascii=False, indent=4)
+        os.replace(temp_filename, filename)
+    except OSError:
+        logging.exception(f"Can't write to the file {filename}.")
+        return False
+
+    return True
+
+# Saves items from any iterable to a JSON Lines file (one item per line)
+def save_items_jsonl(items, filename: str) -> bool:
+    try:
+        with open(filename, 'w', encoding='utf-8') as f:
+            for item in items:
+                f.write(json.dumps(item, ensure_ascii=False) + '\n')
     except OSError:
         logging.exception(f"Can't write to the file {filename}.")
         return False
@@ -0,0 +1,109 @@
+import time
+import logging
+import threading
+
+# Keeps one standby access token ready. Tokens are produced in a background
+# thread by the factory function (which returns None on failure), so a token
+# refused by the API can be replaced instantly. After every take() the next
+# standby token starts being prepared.
+#
+# Tokens are dicts with 'access_token' and 'expires' (UNIX time, may be None)
+# keys. A standby token expiring within the margin (seconds) is discarded by
+# take() and the new one is prepared instead.
+class TokenProvider():
+    def __init__(self, factory, name: str='token', margin: float=0):
+        self.factory = factory
+        self.name = name
+        self.margin = margin
+
+        # Don't change these atrributes from outside the class instance
+        self.condition = threading.Condition()
+        self.standby = None
+        self.requested = False
+        self.failed = False
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        with self.condition:
+            if self.thread != None and self.thread.is_alive():
+                return
+
+            self.stopped = False
+            self.thread = threading.Thread(target=self._run, daemon=True,
+                                           name=f'{self.name} provider')
+            self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (not self.requested or
+                                            self.standby != None):
+                    self.condition.wait()
+
+                if self.stopped:
+                    return
+
+                self.requested = False
+
+            logging.info(f'Preparing standby {self.name}.')
+            try:
+                token = self.factory()
+            except Exception:
+                logging.exception(f'Error while preparing {self.name}.')
+                token = None
+
+            with self.condition:
+                if token is None:
+                    logging.error(f"Can't prepare standby {self.name}.")
+                    self.failed = True
+                else:
+                    logging.info(f'Standby {self.name} is ready.')
+                    self.standby = token
+                self.condition.notify_all()
+
+    # Starts preparing the standby token (if it's not ready yet) without
+    # waiting for it
+    def prepare(self):
+        self.start()
+
+        with self.condition:
+            if self.standby is None:
+                self.failed = False
+                self.requested = True
+                self.condition.notify_all()
+
+    def _expired(self, token: dict) -> bool:
+        expires = token.get('expires')
+        return expires != None and expires - self.margin <= time.time()
+
+    # Returns the standby token (waits for it if it's not ready yet) or None
+    # if the token can't be prepared
+    def take(self) -> dict:
+        self.prepare()
+
+        with self.condition:
+            while True:
+                while (self.standby is None and not self.failed and
+                       not self.stopped):
+                    self.condition.wait()
+
+                token, self.standby = self.standby, None
+
+                if token is None:
+                    return None
+
+                self.requested = True
+                self.condition.notify_all()
+
+                if not self._expired(token):
+                    return token
+
+                logging.info(f'Standby {self.name} has expired. '
+                             'Preparing a new one.')
+                self.failed = False
@@ -1,58 +1,291 @@
-import subprocess
+import os
+import re
 import time
+import socket
+import logging
+import tempfile
+import threading
+import subprocess
 
 import requests
 
 TOR_EXECUTABLE_PATH = 'C:/Tor/Tor/tor.exe'
 
-TOR_SOCKS_PROXIES = {
-    'http': 'socks5://127.0.0.1:9050',
-    'https': 'socks5://127.0.0.1:9050'
-}
+TOR_HOST = '127.0.0.1'
+TOR_SOCKS_PORT = 9050
+TOR_CONTROL_PORT = 9051
+
+# Ports of the pool instances are shifted by this step: the instance with
+# index i uses TOR_SOCKS_PORT + i * TOR_PORT_STEP, etc.
+TOR_PORT_STEP = 2
+
+# Parent folder for data directories of the pool instances
+TOR_DATA_DIR = 'tor_data'
+
+# The control port requires the cookie TOR writes to this file in the data
+# directory (TOR_DATA_DIR for the instance with the default data directory),
+# so other local processes can't control the instance
+TOR_COOKIE_FILENAME = 'control_auth_cookie'
 
-TOR_STARTUP_TIME = 15
+# Maximum time for TOR bootstrapping (seconds)
+TOR_STARTUP_TIME = 60
+
+# Bootstrap status polling period (seconds)
+TOR_BOOTSTRAP_POLL = 0.5
+
+# Timeout for control port connections (seconds)
+TOR_CONTROL_TIMEOUT = 10
+
+# The delay after NEWNYM signal while TOR builds new circuits (seconds)
+TOR_NEWNYM_DELAY = 1
 
 HTTP_BIN_HOST = 'https://httpbin.org/'
 
+BOOTSTRAP_PROGRESS_RE = re.compile(r'PROGRESS=(\d+)')
+
+# Returns proxies dict for requests library. TOR isolates streams with
+# different SOCKS credentials, so every isolation key gets its own circuit.
+def get_socks_proxies(host: str=TOR_HOST, port: int=TOR_SOCKS_PORT,
+                      isolation_key: str=None) -> dict:
+    if isolation_key:
+        proxy = f'socks5://{isolation_key}:{isolation_key}@{host}:{port}'
+    else:
+        proxy = f'socks5://{host}:{port}'
+
+    return {'http': proxy, 'https': proxy}
+
+# Long-lived TOR instance. New identities are requested via the control
+# port instead of restarting the process.
 class TorProxy():
-    def __init__(self, executable_path: str=TOR_EXECUTABLE_PATH):
+    def __init__(self, executable_path: str=TOR_EXECUTABLE_PATH,
+                 socks_port: int=TOR_SOCKS_PORT,
+                 control_port: int=TOR_CONTROL_PORT,
+                 data_dir: str=None):
         self.executable_path = executable_path
+        self.socks_port = socks_port
+        self.control_port = control_port
+        self.data_dir = data_dir
+        self.cookie_file = os.path.join(data_dir or TOR_DATA_DIR,
+                                        TOR_COOKIE_FILENAME)
         self.process = None
+        self.output = None
+
+        # Don't change these atrributes from outside the class instance
+        self.lock = threading.RLock()
 
     def __del__(self):
         self.terminate()
 
-    def restart(self, wait: bool=False) -> bool:
-        self.terminate()
-        self.process = subprocess.Popen(args=[self.executable_path],
-                                        stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE)
-        if wait:
-            time.sleep(TOR_STARTUP_TIME)
+    def get_proxies(self, isolation_key: str=None) -> dict:
+        return get_socks_proxies(TOR_HOST, self.socks_port, isolation_key)
 
-    def is_running(self) -> bool:
-        return self.process != None and self.process.poll() == None
+    # Sends commands to the control port. Returns the list of replies (one
+    # string per command) or None on failure.
+    def control(self, commands: list) -> list:
+        try:
+            # TOR writes a new cookie every time it starts
+            with open(self.cookie_file, 'rb') as f:
+                cookie = f.read()
 
-    def terminate(self):
-        if self.is_running():
-            self.process.terminate()
+            with socket.create_connection(
+                    (TOR_HOST, self.control_port),
+                    timeout=TOR_CONTROL_TIMEOUT) as connection:
+                stream = connection.makefile('rwb')
+                replies = []
+
+                for command in ['AUTHENTICATE ' + cookie.hex()] + commands:
+                    stream.write(command.encode('ascii') + b'\r\n')
+                    stream.flush()
+
+                    lines = []
+                    while True:
+                        line = stream.readline().decode('ascii', 'ignore')
+                        if not line:
+                            return None
+                        lines.append(line.rstrip('\r\n'))
+                        # The final reply line has a space after the code
+                        if len(line) > 3 and line[3] == ' ':
+                            break
+
+                    if not lines[-1].startswith('250'):
+                        logging.error(f'TOR control command "{command}" '
+                                      + f'failed: {lines[-1]}')
+                        return None
+
+                    replies.append('\n'.join(lines))
+
+                stream.write(b'QUIT\r\n')
+                stream.flush()
+        except OSError:
+            return None
+
+        return replies[1:]
+
+    def get_bootstrap_progress(self) -> int:
+        replies = self.control(['GETINFO status/bootstrap-phase'])
+        if not replies:
+            return None
+
+        match = BOOTSTRAP_PROGRESS_RE.search(replies[0])
+        return int(match.group(1)) if match else None
+
+    def is_ready(self) -> bool:
+        return self.get_bootstrap_progress() == 100
+
+    def wait_ready(self, timeout: float=TOR_STARTUP_TIME) -> bool:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.is_ready():
+                return True
+
+            if self.process != None and self.process.poll() != None:
+                logging.error('TOR process terminated unexpectedly.')
+                return False
+
+            time.sleep(TOR_BOOTSTRAP_POLL)
+
+        logging.error('Timeout while waiting for TOR bootstrapping.')
+        return False
+
+    # Starts the TOR process unless the instance is already available
+    def start(self, wait: bool=True) -> bool:
+        with self.lock:
+            return self._start(wait)
+
+    def _start(self, wait: bool) -> bool:
+        if self.is_ready():
+            return True
+
+        if not self.is_running():
+            args = [
+                self.executable_path,
+                '--SocksPort', str(self.socks_port),
+                '--ControlPort', str(self.control_port),
+                '--CookieAuthentication', '1',
+                '--CookieAuthFile', os.path.abspath(self.cookie_file),
+            ]
+            if self.data_dir:
+                args += ['--DataDirectory', self.data_dir]
 
-    def test_ok(self) -> bool:
-        if self.is_running():
+            data_dir = os.path.dirname(self.cookie_file)
             try:
-                r = requests.get(HTTP_BIN_HOST, proxies=TOR_SOCKS_PROXIES)
-            except requests.exceptions.RequestException:
+                os.makedirs(data_dir, exist_ok=True)
+            except OSError:
+                logging.exception("Can't create TOR data directory "
+                                  + f'{data_dir}.')
                 return False
 
-            if r.status_code != requests.codes.ok:
-               return False
+            # A temporary file never blocks TOR like an unread pipe does
+            self.output = tempfile.TemporaryFile()
+            try:
+                self.process = subprocess.Popen(args=args,
+                                                stdout=self.output,
+                                                stderr=subprocess.STDOUT)
+            except OSError:
+                logging.exception("Can't start TOR process.")
+                return False
+
+        if wait:
+            return self.wait_ready()
 
+        return True
+
+    def restart(self, wait: bool=False) -> bool:
+        with self.lock:
+            self.terminate()
+            return self.start(wait=wait)
+
+    # Makes TOR use new circuits (and therefore new exit IPs) for the new
+    # connections. Already established connections keep their circuits.
+    def new_identity(self) -> bool:
+        with self.lock:
+            if not self.start():
+                return False
+
+            if self.control(['SIGNAL NEWNYM']) is None:
+                logging.error("Can't request new TOR identity.")
+                return False
+
+            time.sleep(TOR_NEWNYM_DELAY)
             return True
 
-        return False
+    def is_running(self) -> bool:
+        return self.process != None and self.process.poll() == None
+
+    def terminate(self):
+        with self.lock:
+            if self.is_running():
+                self.process.terminate()
+                try:
+                    self.process.wait(timeout=TOR_CONTROL_TIMEOUT)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+
+    def test_ok(self, proxies: dict=None) -> bool:
+        try:
+            r = requests.get(HTTP_BIN_HOST, proxies=proxies or
+                             self.get_proxies(), timeout=TOR_CONTROL_TIMEOUT)
+        except requests.exceptions.RequestException:
+            return False
+
+        if r.status_code != requests.codes.ok:
+            return False
+
+        return True
 
     def get_output(self) -> str:
-        if self.process != None and self.process.poll() != None:
-            return self.process.stdout.read().decode('ascii', 'ignore')
+        if (self.process != None and self.process.poll() != None and
+                self.output != None):
+            self.output.seek(0)
+            return self.output.read().decode('ascii', 'ignore')
         else:
             return None
+
+# Several independent TOR instances with distinct SOCKS and control ports.
+# Each additional instance keeps its state in its own data directory (TOR
+# refuses to share one), so the instances build their circuits separately
+# and get different exit IPs. The first instance uses the default ports and
+# data directory, so a single-instance pool is the same as TorProxy.
+class TorPool():
+    def __init__(self, size: int=1,
+                 executable_path: str=TOR_EXECUTABLE_PATH,
+                 socks_port: int=TOR_SOCKS_PORT,
+                 control_port: int=TOR_CONTROL_PORT,
+                 data_dir: str=TOR_DATA_DIR):
+        self.instances = [
+            TorProxy(executable_path=executable_path,
+                     socks_port=socks_port + index * TOR_PORT_STEP,
+                     control_port=control_port + index * TOR_PORT_STEP,
+                     data_dir=(os.path.join(data_dir, str(index))
+                               if index > 0 else None))
+            for index in range(size)
+        ]
+
+    def __len__(self) -> int:
+        return len(self.instances)
+
+    def __getitem__(self, index: int) -> TorProxy:
+        return self.instances[index]
+
+    def __iter__(self):
+        return iter(self.instances)
+
+    # All the instances are bootstrapping simultaneously. Returns False if
+    # any of them isn't ready.
+    def start(self, wait: bool=True) -> bool:
+        started = [instance for instance in self.instances
+                   if instance.start(wait=False)]
+        result = len(started) == len(self.instances)
+
+        if wait:
+            for instance in started:
+                if not instance.wait_ready():
+                    logging.error('TOR instance on port '
+                                  + f'{instance.socks_port} is not ready.')
+                    result = False
+
+        return result
+
+    def terminate(self):
+        for instance in self.instances:
+            instance.terminate()